@@ -0,0 +1,238 @@
+import cStringIO
+import os
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+
+
+# Time stamp of every entry: 1980-01-01 00:00:00 UTC, the earliest a zip file
+# can hold. Archives of the same site are byte-identical.
+ENTRY_TIME = 315532800
+
+# Archive file extensions and the format each one selects.
+FORMATS = (('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar', 'tar'),
+           ('.zip', 'zip'))
+
+
+def archive_format(path):
+  '''Get the archive format selected by a file name.
+
+  Args:
+    path: archive file name
+
+  Returns:
+    'tar', 'tar.gz', 'zip' or None if the extension is not known
+  '''
+  for extension, format in FORMATS:
+    if path.endswith(extension):
+      return format
+  return None
+
+
+class GzipStream(object):
+  '''Write-only gzip stream.
+
+  Unlike gzip.GzipFile, the header holds no time stamp or file name, so the
+  same data always compresses to the same bytes.
+  '''
+  def __init__(self, fileobj, level=9):
+    '''Constructor.
+
+    Args:
+      fileobj: file object the compressed stream is written to
+      level: (optional) zlib compression level
+    '''
+    self._fileobj = fileobj
+    self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self._crc = zlib.crc32('')
+    self._size = 0
+    fileobj.write('\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+  def write(self, data):
+    self._crc = zlib.crc32(data, self._crc)
+    self._size += len(data)
+    self._fileobj.write(self._compressor.compress(data))
+
+  def close(self):
+    '''Finish the stream. The underlying file object is left open.'''
+    self._fileobj.write(self._compressor.flush())
+    self._fileobj.write(struct.pack('<II', self._crc & 0xffffffff,
+                                    self._size & 0xffffffff))
+
+
+def gzip_bytes(data, level=9):
+  '''Gzip-compress a string, with a fixed header.'''
+  buf = cStringIO.StringIO()
+  stream = GzipStream(buf, level)
+  stream.write(data)
+  stream.close()
+  return buf.getvalue()
+
+
+class Archive(object):
+  '''Tar or zip file that output files are written into.
+
+  Paths under the site output directory become entry names relative to it.
+  Every entry gets the same time stamp, owner and mode, so the archive only
+  depends on the order entries are added in. Writes are serialized; the
+  caller adds entries from one thread to keep that order fixed. The archive
+  is written to a temporary file and renamed into place by close().
+  '''
+  def __init__(self, path, root, gzip_types=None, gzip_min_size=0):
+    '''Constructor.
+
+    Args:
+      path: archive file name; its extension selects the format
+      root: directory that entry names are relative to
+      gzip_types: (optional) file extensions that also get a .gz entry
+      gzip_min_size: (optional) smallest size in bytes of .gz entries
+    '''
+    self._path = path
+    self._root = root
+    self._format = archive_format(path)
+    if self._format is None:
+      raise ValueError('unknown archive format "%s"' % path)
+    self._gzip_types = gzip_types or []
+    self._gzip_min_size = gzip_min_size
+    self._lock = threading.Lock()
+    self._entries = 0
+
+    self._temp_file = '%s~' % path
+    self._fileobj = open(self._temp_file, 'wb')
+    self._stream = None
+    if self._format == 'zip':
+      # Large sites need zip64 for more than 65535 entries or 2 GiB.
+      self._zip = zipfile.ZipFile(self._fileobj, 'w', zipfile.ZIP_DEFLATED,
+                                  allowZip64=True)
+    else:
+      if self._format == 'tar.gz':
+        self._stream = GzipStream(self._fileobj, 6)
+        self._tar = tarfile.open(mode='w|', fileobj=self._stream)
+      else:
+        self._tar = tarfile.open(mode='w|', fileobj=self._fileobj)
+
+  def path(self):
+    return self._path
+
+  def entries(self):
+    '''Get the number of entries written so far.'''
+    return self._entries
+
+  def entryName(self, path):
+    '''Get the entry name of a path under the output directory.'''
+    return os.path.relpath(path, self._root).replace(os.sep, '/')
+
+  def label(self, path):
+    '''Describe where a path under the output directory is written.'''
+    return '%s:%s' % (self._path, self.entryName(path))
+
+  def addBytes(self, path, content):
+    '''Add an entry holding a string.
+
+    Args:
+      path: full filesystem path under the output directory
+      content: string
+    '''
+    self._lock.acquire()
+    try:
+      name = self.entryName(path)
+      if self._format == 'zip':
+        self._zip.writestr(self._zipInfo(name), content)
+      else:
+        self._tar.addfile(self._tarInfo(name, len(content)),
+                          cStringIO.StringIO(content))
+      self._entries += 1
+      if self._compressible(name, len(content)):
+        self._addGzip(name, content)
+    finally:
+      self._lock.release()
+
+  def addFile(self, path, source):
+    '''Add an entry with the content of a file.
+
+    Tar entries are streamed from the source file. The zip module cannot
+    stream an entry with a time stamp other than the file's, so for zip
+    archives the file is read whole.
+
+    Args:
+      path: full filesystem path under the output directory
+      source: full filesystem path of the file to add
+    '''
+    self._lock.acquire()
+    try:
+      name = self.entryName(path)
+      fh = open(source, 'rb')
+      try:
+        size = os.fstat(fh.fileno()).st_size
+        if self._format == 'zip':
+          self._zip.writestr(self._zipInfo(name), fh.read())
+        else:
+          self._tar.addfile(self._tarInfo(name, size), fh)
+        self._entries += 1
+        if self._compressible(name, size):
+          fh.seek(0)
+          self._addGzip(name, fh.read())
+      finally:
+        fh.close()
+    finally:
+      self._lock.release()
+
+  def close(self):
+    '''Finish the archive and move it into place.'''
+    if self._format == 'zip':
+      self._zip.close()
+    else:
+      self._tar.close()
+      if self._stream is not None:
+        self._stream.close()
+    self._fileobj.close()
+    os.rename(self._temp_file, self._path)
+
+  def abort(self):
+    '''Give up on the archive, removing the temporary file. An archive
+    already at the path is left as it was.'''
+    try:
+      if self._format == 'zip':
+        self._zip.close()
+      else:
+        self._tar.close()
+    except (IOError, OSError, ValueError):
+      pass  # the entries are thrown away anyway
+    finally:
+      self._fileobj.close()
+      os.remove(self._temp_file)
+
+  def _compressible(self, name, size):
+    return (size >= self._gzip_min_size and
+            os.path.splitext(name)[1] in self._gzip_types)
+
+  def _addGzip(self, name, content):
+    name = '%s.gz' % name
+    content = gzip_bytes(content)
+    if self._format == 'zip':
+      info = self._zipInfo(name)
+      info.compress_type = zipfile.ZIP_STORED  # already compressed
+      self._zip.writestr(info, content)
+    else:
+      self._tar.addfile(self._tarInfo(name, len(content)),
+                        cStringIO.StringIO(content))
+    self._entries += 1
+
+  def _tarInfo(self, name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = ENTRY_TIME
+    info.mode = 0644
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+  def _zipInfo(self, name):
+    info = zipfile.ZipInfo(name, time.gmtime(ENTRY_TIME)[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0644 << 16
+    return info
+
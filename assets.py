@@ -0,0 +1,93 @@
+'''Content-hashed names of static files.
+
+A fingerprinted copy of a file has part of its content digest in its name,
+e.g. css/site.css -> css/site.0123abcd.css. A change of content gives a new
+name, so browsers can cache fingerprinted files for good. Pages and layouts
+refer to the fingerprinted names through an AssetManifest; files are still
+written under their own names too, for links and hand-written references.
+'''
+import json
+import os
+
+
+# Number of hex digits of the content digest in a fingerprinted name.
+DIGEST_LENGTH = 8
+
+# Name of the manifest written to the root of the site.
+MANIFEST_NAME = 'assets.json'
+
+
+def fingerprinted_name(name, digest):
+  '''Get the fingerprinted name of a file.
+
+  Args:
+    name: file name relative to the site root, e.g. 'css/site.css'
+    digest: hex digest of the file content
+
+  Returns:
+    file name with the digest before the extension
+  '''
+  root, ext = os.path.splitext(name)
+  return '%s.%s%s' % (root, digest[:DIGEST_LENGTH], ext)
+
+
+def load_manifest(path):
+  '''Load a manifest written by AssetManifest.dumps().
+
+  Returns:
+    AssetManifest, empty if the file does not exist
+  '''
+  if not os.path.isfile(path):
+    return AssetManifest()
+  fh = open(path, 'r')
+  try:
+    return AssetManifest(json.load(fh))
+  finally:
+    fh.close()
+
+
+class AssetManifest(object):
+  '''Fingerprinted names of a site's static files, by their own names.'''
+  def __init__(self, names=None):
+    '''Constructor.
+
+    Args:
+      names: (optional) dict of fingerprinted names by file name
+    '''
+    self._names = dict(names or {})
+
+  def __len__(self):
+    return len(self._names)
+
+  def add(self, file):
+    '''Fingerprint a file.
+
+    Args:
+      file: filesystem.File; its cached content digest is used
+
+    Returns:
+      fingerprinted name
+    '''
+    name = fingerprinted_name(file.name(), file.digest())
+    self._names[file.name()] = name
+    return name
+
+  def name(self, name):
+    '''Get the name a file is referred to by.
+
+    Args:
+      name: file name relative to the site root
+
+    Returns:
+      the fingerprinted name, or name itself if the file has none
+    '''
+    return self._names.get(name, name)
+
+  def fingerprinted(self):
+    '''Get the set of fingerprinted names.'''
+    return set(self._names.itervalues())
+
+  def dumps(self):
+    '''Get the manifest as JSON, mapping names to fingerprinted names.'''
+    return json.dumps(self._names, sort_keys=True, indent=1,
+                      separators=(',', ': '))
@@ -0,0 +1,249 @@
+#!/usr/bin/env python2.6
+# -*- mode: Python -*-
+'''Micro-benchmarks for infmx internals.
+
+usage: bench.py text [SIZE_MB]
+       bench.py parser [SIZE_MB]
+       bench.py blocks [SIZE_MB]
+       bench.py stream [SIZE_MB]
+       bench.py fuzz [COUNT [SEED]]
+'''
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import creole
+import document
+import filesystem
+import scanner
+
+
+def sample_source(size):
+  '''Generate Creole source of roughly the given size in bytes.'''
+  section = (u'== Section %d\n\n'
+             u'Some **bold** and //italic// text with a [[#link]] and '
+             u'non-ASCII characters: caf\xe9, na\xefve, \u65e5\u672c.\n'
+             u'* first item\n* second item\n\n'
+             u'|= head |= head |\n| cell | cell |\n\n'
+             u'{{{\nsome preformatted <text>\n}}}\n\n')
+  parts = []
+  total = 0
+  i = 0
+  while total < size:
+    part = (section % i).encode('utf-8')
+    parts.append(part)
+    total += len(part)
+    i += 1
+  return '= Sample\n\n' + ''.join(parts)
+
+
+def best_of(fn, runs=5):
+  best = None
+  for _ in xrange(runs):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def bench_text(size_mb=5):
+  '''Compare text conversions around rendering a large page.
+
+  The previous pipeline decoded the source with 'ignore', encoded the
+  emitted HTML to UTF-8, had Django decode it again for the template and
+  encoded the page once more for writing. The current one decodes the source
+  once and encodes the page once. The amount copied is measured as the
+  memory taken by the strings each conversion creates.
+  '''
+  raw = sample_source(int(size_mb * 1024 * 1024))
+  ds = document.DocumentSet()
+  root = document.Parser(unicode(raw, 'utf-8')).parse()
+  html = document.HtmlEmitter(ds, root).emit()
+
+  def old_pipeline():
+    text = unicode(raw, 'utf-8', 'ignore')       # Document._parse
+    body = html.encode('utf-8', 'ignore')        # Document.to_html
+    page = unicode(body, 'utf-8')                # Django force_unicode
+    return [text, body, page, page.encode('utf-8')]  # writing the page
+
+  def new_pipeline():
+    text = unicode(raw, 'utf-8')                 # File.text
+    return [text, html.encode('utf-8')]          # writeDocument
+
+  def copied_mb(pipeline):
+    return sum([sys.getsizeof(s) for s in pipeline()]) / 1048576.0
+
+  encoded = len(html.encode('utf-8'))
+  old = best_of(old_pipeline)
+  new = best_of(new_pipeline)
+  print 'Source: %.1f MB, HTML: %.1f MB (UTF-8)' % (
+    len(raw) / 1048576.0, encoded / 1048576.0)
+  print 'Old pipeline: 4 conversions, %.1f MB copied, %.3fs' % (
+    copied_mb(old_pipeline), old)
+  print 'New pipeline: 2 conversions, %.1f MB copied, %.3fs' % (
+    copied_mb(new_pipeline), new)
+
+
+def bench_parser(size_mb=2):
+  '''Compare the parser engines on a large page.'''
+  raw = unicode(sample_source(int(size_mb * 1024 * 1024)), 'utf-8')
+  print 'Source: %.1f MB' % (len(raw) / 1048576.0)
+  times = {}
+  for name in sorted(document.PARSERS):
+    parser = document.PARSERS[name]
+    times[name] = best_of(lambda: parser(raw).parse(), runs=3)
+    print '%-8s %.3fs' % (name, times[name])
+  print 'scanner speedup: %.1fx' % (times['creole'] / times['scanner'])
+
+
+def bench_blocks(size_mb=2):
+  '''Time re-parsing a large page after a one-paragraph edit.'''
+  raw = unicode(sample_source(int(size_mb * 1024 * 1024)), 'utf-8')
+  edited = raw.replace(u'Some **bold**', u'Some edited **bold**', 1)
+  parser = document.PARSERS['scanner']
+  cache = document.BlockCache()
+  cache.parse(raw, parser)
+  cache.newGeneration()
+  full = best_of(lambda: parser(edited).parse(), runs=3)
+  parsed_before, reused_before = cache.stats()
+  start = time.time()
+  cache.parse(edited, parser)
+  incremental = time.time() - start
+  parsed, reused = cache.stats()
+  print 'Source: %.1f MB' % (len(raw) / 1048576.0)
+  print 'Full parse:        %.3fs' % full
+  print 'Incremental parse: %.3fs   (%d blocks parsed, %d reused)' % (
+    incremental, parsed - parsed_before, reused - reused_before)
+
+
+def peak_rss_mb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_stream(size_mb=20):
+  '''Compare peak memory of rendering a huge page whole and streamed.
+
+  Peak RSS only grows, so the streamed render runs first.
+  '''
+  fd, path = tempfile.mkstemp(suffix='.txt')
+  os.write(fd, sample_source(int(size_mb * 1024 * 1024)))
+  os.close(fd)
+  try:
+    print 'Source: %.1f MB' % (os.path.getsize(path) / 1048576.0)
+    baseline = peak_rss_mb()
+    for name, stream_size in (('Streamed', 0), ('Whole', None)):
+      ds = document.DocumentSet(stream_size=stream_size)
+      doc = ds.documentNew(filesystem.File('page.txt', path))
+      start = time.time()
+      doc.title()
+      doc.summary()
+      html = doc.to_html()
+      elapsed = time.time() - start
+      peak = peak_rss_mb()
+      print '%-8s %.3fs   peak RSS +%.1f MB   (%.1f MB of HTML)' % (
+        name, elapsed, peak - baseline, len(html) / 1048576.0)
+      baseline = peak
+      del ds, doc, html
+  finally:
+    os.remove(path)
+
+
+# Pieces of markup that random documents are assembled from; chosen to hit
+# the corners of the Creole rules.
+FUZZ_FRAGMENTS = [
+  u'\n', u'\n', u'\n\n', u' ', u'  ', u'\t', u'\r', u'\xa0', u'a', u'word',
+  u'caf\xe9', u'=', u'==', u' = ', u'-', u'----', u'{{{', u'}}}', u'~}}}',
+  u'#!', u'py', u'{{', u'}}', u'x.png', u'[[', u']]', u'|', u'||', u'|=',
+  u'<<', u'>>', u'(', u')', u'*', u'**', u'#', u'##', u'//', u'://', u':',
+  u'~', u'\\', u'\\\\', u'.', u',', u'!', u'http://x.org', u'https://a/b',
+  u'irc:', u'\n{{{\n', u'\n}}}\n',
+]
+
+
+def tree_signature(node):
+  '''Get a comparable representation of a DocNode tree.'''
+  return (node.kind, node.content, getattr(node, 'level', None),
+          getattr(node, 'args', None), getattr(node, 'sect', None),
+          [tree_signature(child) for child in node.children])
+
+
+def joined_pieces(nodes):
+  '''Join the pieces of tables and paragraphs cut by document.parse_blocks.'''
+  joined = []
+  for node in nodes:
+    if getattr(node, 'split', None) in ('middle', 'last'):
+      joined[-1].children.extend(node.children)
+    else:
+      joined.append(node)
+  return joined
+
+
+def bench_fuzz(count=20000, seed=0):
+  '''Check that the parser engines agree on random documents.
+
+  Each document is also parsed block by block through a BlockCache, and
+  streamed in random pieces through document.parse_blocks, once more with a
+  small limit so that tables and paragraphs are cut; all must give the same
+  tree as parsing it whole.
+  '''
+  rand = random.Random(seed)
+  failures = 0
+  start = time.time()
+  for _ in xrange(int(count)):
+    raw = u''.join(rand.choice(FUZZ_FRAGMENTS)
+                   for _ in xrange(rand.randint(0, 60)))
+    expected = tree_signature(creole.Parser(raw).parse())
+    pieces = []
+    pos = 0
+    while pos < len(raw):
+      size = rand.randint(1, 16)
+      pieces.append(raw[pos:pos + size])
+      pos += size
+    streamed = creole.DocNode('document', None)
+    streamed.children = list(document.parse_blocks(pieces, creole.Parser))
+    cut = creole.DocNode('document', None)
+    cut.children = joined_pieces(document.parse_blocks(
+      pieces, creole.Parser, rand.randint(1, 32)))
+    results = [
+      ('scanner', scanner.Parser(raw).parse()),
+      ('blocks', document.BlockCache().parse(raw, creole.Parser)),
+      ('stream', streamed),
+      ('cut', cut),
+    ]
+    for name, root in results:
+      actual = tree_signature(root)
+      if actual != expected:
+        failures += 1
+        if failures <= 3:
+          print 'Mismatch for %r:\n  creole: %r\n  %s: %r' % (
+            raw, expected, name, actual)
+  print '%d documents, %d mismatches, %.1fs' % (
+    count, failures, time.time() - start)
+  if failures:
+    sys.exit(1)
+
+
+BENCHMARKS = {
+  'text': bench_text,
+  'parser': bench_parser,
+  'blocks': bench_blocks,
+  'stream': bench_stream,
+  'fuzz': bench_fuzz,
+}
+
+
+def main():
+  if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+    print __doc__.strip()
+    sys.exit(1)
+  args = [float(arg) for arg in sys.argv[2:]]
+  BENCHMARKS[sys.argv[1]](*args)
+
+
+if __name__ == '__main__':
+  main()
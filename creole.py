@@ -136,6 +136,11 @@ class Parser:
         Rules.code, Rules.image, Rules.strong, Rules.emph, Rules.linebreak,
         Rules.escape, Rules.char]), re.X | re.U)
 
+    # When set, every match is handled through hook(name, replace, groups),
+    # which must return replace(groups); name is the matched group. The hook
+    # is a callable object such as instrument.KindTimer.
+    hook = None
+
     def __init__(self, raw):
         self.raw = raw
         self.root = DocNode('document', None)
@@ -353,7 +358,10 @@ class Parser:
         for name, text in groups.iteritems():
             if text is not None:
                 replace = getattr(self, '_%s_repl' % name)
-                replace(groups)
+                if self.hook is None:
+                    replace(groups)
+                else:
+                    self.hook(name, replace, groups)
                 return
 
     def parse_inline(self, raw):
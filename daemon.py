@@ -0,0 +1,110 @@
+import logging
+import os
+import socket
+import SocketServer
+import stat
+import StringIO
+import sys
+
+
+# Last line of a daemon reply, carrying the exit status of the build.
+DAEMON_STATUS = 'infmx-status: '
+
+
+class DaemonError(Exception):
+  '''The build daemon cannot be started.'''
+
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+  '''Runs a build for each "build" request and replies with its output.'''
+  def handle(self):
+    command = self.rfile.readline().strip()
+    if not command:
+      return  # a connection test by startDaemon
+    if command != 'build':
+      self.wfile.write('Unknown command "%s"\n%s1\n' % (command,
+                                                         DAEMON_STATUS))
+      return
+
+    status = 0
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      try:
+        self.server.build()
+      except SystemExit, e:
+        status = e.code or 0
+      except Exception, e:
+        logging.exception('Build failed')
+        print 'Error: build failed: %s' % e
+        status = 1
+    finally:
+      output = sys.stdout.getvalue()
+      sys.stdout = stdout
+    self.wfile.write(output)
+    self.wfile.write('%s%d\n' % (DAEMON_STATUS, status))
+
+
+def _removeStaleSocket(socket_path):
+  '''Remove the socket left behind by a daemon that is no longer running.
+
+  Raises:
+    DaemonError: if the path is not a socket, or a daemon listens on it
+  '''
+  try:
+    mode = os.lstat(socket_path).st_mode
+  except OSError:
+    return
+  if not stat.S_ISSOCK(mode):
+    raise DaemonError('"%s" exists and is not a socket' % socket_path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except socket.error:
+    os.remove(socket_path)
+    return
+  finally:
+    sock.close()
+  raise DaemonError('a build daemon is already listening on %s' % socket_path)
+
+
+def startDaemon(socket_path, build_fn):
+  '''Serve build requests on a Unix socket, keeping state warm in memory.
+
+  Args:
+    socket_path: path of the Unix socket to listen on
+    build_fn: function that runs one build
+
+  Raises:
+    DaemonError: if socket_path is taken
+  '''
+  _removeStaleSocket(socket_path)
+  server = SocketServer.UnixStreamServer(socket_path, DaemonRequestHandler)
+  server.build = build_fn
+
+  print 'Build daemon listening on %s' % socket_path
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.remove(socket_path)
+
+
+def requestBuild(socket_path):
+  '''Ask a build daemon to build, print its output and return its status.'''
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except socket.error, e:
+    print 'Error: cannot connect to build daemon at %s: %s' % (socket_path, e)
+    return 1
+  sock.sendall('build\n')
+
+  status = 1
+  for line in sock.makefile('r'):
+    if line.startswith(DAEMON_STATUS):
+      status = int(line[len(DAEMON_STATUS):])
+    else:
+      sys.stdout.write(line)
+  sock.close()
+  return status
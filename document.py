@@ -1,14 +1,13 @@
+import bisect
+import hashlib
 import logging
 import os
 import re
 import time
 
 import creole
-import pygments
-import pygments.lexers
-import pygments.formatters
-
 import filesystem
+import scanner
 
 
 def document_url(docname):
@@ -130,17 +129,19 @@ class Link(object):
              self.text))
 
 
+# Interwiki keywords known to every site. Sites may add to or override these
+# with an "interwiki" mapping in _config.yml.
+INTERWIKI_DEFAULTS = {'wp': 'http://en.wikipedia.org/wiki/',
+                      'g': 'http://www.google.com/search?q='}
+
+
 class InterwikiLinker(object):
   '''Create links to other web apps or wikis.
 
   Attributes:
     link: Link object
   '''
-  # TODO(ms): this should not be here, and instead in site settings
-  _WIKITABLE = {'wp': 'http://en.wikipedia.org/wiki/',
-                'g': 'http://www.google.com/search?q='}
-
-  def __init__(self, wikikey, term, text=None, target=None):
+  def __init__(self, wikikey, term, text=None, target=None, wikitable=None):
     '''Constructor.
 
     Args:
@@ -148,19 +149,148 @@ class InterwikiLinker(object):
       term: term on external wiki to link to
       text: (optional) alternate text to use for link
       target: (optional) override the default link target of "_blank"
+      wikitable: (optional) dict of wiki keywords to URL prefixes
     '''
-    if wikikey not in self._WIKITABLE:
+    if wikitable is None:
+      wikitable = INTERWIKI_DEFAULTS
+    if wikikey not in wikitable:
       raise ValueError, '"%s" is not a recognized wiki keyword' % wikikey
     if text is None:
       text = term
     if target is None:
       target = '_blank'
 
-    href = u'%s%s' % (self._WIKITABLE[wikikey], term)
+    href = u'%s%s' % (wikitable[wikikey], term)
     css_class = u'iw iw_%s' % wikikey
     self.link = Link(href, text, target=target, css_class=css_class)
 
 
+class ResolvedLink(object):
+  '''A link target resolved by LinkResolver.
+
+  Attributes:
+    kind: 'extern', 'intern', 'interwiki', 'page' or 'site'
+    href: final href for the target
+    title: default link text (document title or interwiki term), or None
+    target: link target ("_blank") or None
+    css_class: CSS class for links to this target, or None
+  '''
+  def __init__(self, kind, href, title=None, target=None, css_class=None):
+    self.kind = kind
+    self.href = href
+    self.title = title
+    self.target = target
+    self.css_class = css_class
+
+
+class LinkResolver(object):
+  '''Table of link targets resolved during a build.
+
+  The same targets are linked from many pages, so both the ADDR_RE
+  classification and the resolved link are memoized by target string.
+  '''
+  def __init__(self, ds, interwiki=None):
+    '''Constructor.
+
+    Args:
+      ds: DocumentSet used to look up intrawiki targets
+      interwiki: (optional) dict of additional interwiki keywords
+    '''
+    self._ds = ds
+    self._wikitable = dict(INTERWIKI_DEFAULTS)
+    if interwiki:
+      self._wikitable.update(interwiki)
+    self._kinds = {}
+    self._links = {}
+    self._unresolved = set()
+
+  def classify(self, target):
+    '''Classify a link or image target.
+
+    Args:
+      target: target string
+
+    Returns:
+      (kind, match) tuple; kind is 'site' and match is None if the target
+      does not match ADDR_RE
+    '''
+    try:
+      return self._kinds[target]
+    except KeyError:
+      pass
+
+    m = ADDR_RE.match(target)
+    if m is None:
+      kind = 'site'
+    elif m.group('extern_addr'):
+      kind = 'extern'
+    elif m.group('intern_addr'):
+      kind = 'intern'
+    elif m.group('inter_wiki'):
+      kind = 'interwiki'
+    elif m.group('page_addr'):
+      kind = 'page'
+    else:
+      # matched ADDR_RE, but not any of the rules
+      raise NotImplementedError
+
+    self._kinds[target] = (kind, m)
+    return (kind, m)
+
+  def resolve(self, target):
+    '''Resolve a link target.
+
+    Args:
+      target: target string
+
+    Returns:
+      ResolvedLink
+    '''
+    try:
+      return self._links[target]
+    except KeyError:
+      pass
+
+    kind, m = self.classify(target)
+    # external links (http://...)
+    if kind == 'extern':
+      link = ResolvedLink(kind, target, target='_blank', css_class='urle')
+    # intrawiki links ([[articles/irssi]])
+    elif kind == 'intern':
+      title = None
+      if self._ds.contains(target):
+        title = self._ds.document(target).title()
+      else:
+        self._unresolved.add(target)
+      link = ResolvedLink(kind, document_url(target), title=title,
+                          css_class='urli')
+    # interwiki links ([[wp>Python]])
+    elif kind == 'interwiki':
+      a = InterwikiLinker(m.group('inter_wiki'), m.group('inter_term'),
+                          wikitable=self._wikitable).link
+      link = ResolvedLink(kind, a.href, title=a.text, target=a.target,
+                          css_class=a.css_class)
+    # intrapage links ([[#foosection]]) and on-site links (/some/file)
+    else:
+      link = ResolvedLink(kind, target)
+
+    self._links[target] = link
+    return link
+
+  def unresolved(self):
+    '''Get the intrawiki targets that did not name a document.
+
+    Returns:
+      sorted list of target strings
+    '''
+    return sorted(self._unresolved)
+
+  def invalidate(self):
+    '''Forget all resolved targets, e.g. after documents changed.'''
+    self._links = {}
+    self._unresolved = set()
+
+
 class LinkNode(object):
   def __init__(self, ds, node, inside=None):
     '''Link node object.
@@ -172,62 +302,94 @@ class LinkNode(object):
     self._ds = ds
     self._node = node
     self._target = node.content
-    self._inside = inside
 
+    link = self._ds.links().resolve(self._target)
     if inside:
-      self._inside_empty = False
+      text = inside
+    elif link.title is not None:
+      text = link.title
     else:
-      self._inside = html_escape(self._target)
-      self._inside_empty = True
+      text = html_escape(self._target)
 
-    m = ADDR_RE.match(self._target)
-    # external links (http://...)
-    if m and m.group('extern_addr'):
-      self._link = Link(self._target, self._inside, target='_blank',
-                        css_class='urle')
-    # intrawiki links ([[articles/irssi]])
-    elif m and m.group('intern_addr'):
-      if self._inside_empty and self._ds.contains(self._target):
-        self._inside = self._ds.document(self._target).title()
-      self._link = Link(document_url(self._target),
-                        self._inside, css_class='urli')
-    # interwiki links ([[wp>Python]])
-    elif m and m.group('inter_wiki'):
-      if self._inside_empty:
-        self._inside = None
-      self._link = InterwikiLinker(m.group('inter_wiki'),
-                                   m.group('inter_term'),
-                                   text=self._inside).link
-    # intrapage links ([[#foosection]])
-    elif m and m.group('page_addr'):
-      self._link = Link(self._target, self._inside)
-    # matched ADDR_RE, but not any of the rules
-    elif m:
-      raise NotImplementedError
-    else:
-      # on-site links (/some/file)
-      self._link = Link(self._target, self._inside)
+    self._link = Link(link.href, text, target=link.target,
+                      css_class=link.css_class)
 
   def to_html(self):
     return self._link.to_html()
 
 
+class GenerationalCache(object):
+  '''Cache that keeps the entries used in its current or previous
+  generation.
+
+  A hit moves an entry to the current generation; starting a new one drops
+  the entries that were not used in the current one. With a size, a full
+  current generation starts a new one by itself.
+  '''
+  def __init__(self, size=None):
+    '''Constructor.
+
+    Args:
+      size: (optional) maximum number of entries of a generation
+    '''
+    self._size = size
+    self._current = {}
+    self._previous = {}
+
+  def newGeneration(self):
+    self._previous = self._current
+    self._current = {}
+
+  def get(self, key):
+    '''Get a cached value, or None.'''
+    value = self._current.get(key)
+    if value is None:
+      value = self._previous.get(key)
+      if value is not None:
+        self.put(key, value)
+    return value
+
+  def put(self, key, value):
+    if self._size is not None and len(self._current) >= self._size:
+      self.newGeneration()
+    self._current[key] = value
+
+
+# Highlighted HTML of preformatted blocks, keyed by a digest of the lexer
+# name, options and text. Highlighting depends on nothing else, so the cache
+# is shared by all documents and sites built in the process; the size of its
+# generations bounds what the daemon and --batch keep.
+HIGHLIGHT_CACHE_SIZE = 1000
+_highlighted = GenerationalCache(HIGHLIGHT_CACHE_SIZE)
+
+# pygments lexers by name.
+_lexers = {}
+
+
 class PreNode(object):
+  # Option headers at the start of a preformatted block, e.g. "lang: python".
+  _OPTION_RE = re.compile(r'\s*(noescape|raw|lang|linenos)\s*:\s*(\w+)\s*')
+
   def __init__(self, node):
     '''Preformatted text node object.
 
     Args:
       node: DocNode
     '''
-    self._content = node.content
     self._escape = True
     self._raw = False
     self._lexer = None
+    self._linenos = True
 
+    # Consume option headers in a single anchored pass and slice them off the
+    # front of the content once at the end.
+    content = node.content
+    pos = 0
     while True:
-      m = re.search(r'^\s*(noescape|raw|lang)\s*:\s*(\w+)\s*', self._content)
+      m = self._OPTION_RE.match(content, pos)
       if not m:
         break
+      pos = m.end()
 
       key = m.group(1).lower()
       value = m.group(2).lower()
@@ -238,34 +400,61 @@ class PreNode(object):
         self._raw = True
       elif key == 'lang':
         self._lexer = value
+      elif key == 'linenos':
+        self._linenos = (value == 'true')
 
-      self._content = re.sub(m.group(0), u'', self._content)
+    self._content = content[pos:]
 
   def to_html(self):
     def tag(content, raw):
       return raw and content or u'<pre>%s</pre>' % content
 
     if self._lexer:
-      if self._lexer == 'guess':
-        lexer = pygments.lexers.guess_lexer(self._content)
-      else:
-        lexer = pygments.lexers.get_lexer_by_name(self._lexer)
-
-      formatter = pygments.formatters.HtmlFormatter(linenos=True,
-                                                    cssclass='syntax')
-      return pygments.highlight(self._content, lexer, formatter)
+      key = hashlib.md5(repr((self._lexer, self._linenos)))
+      key.update(self._content.encode('utf-8'))
+      key = key.digest()
+      html = _highlighted.get(key)
+      if html is None:
+        html = self._highlight()
+        _highlighted.put(key, html)
+      return html
 
     if self._escape:
       return tag(html_escape(self._content), self._raw)
     else:
       return tag(self._content, self._raw)
 
+  def _highlight(self):
+    # Highlighting is rare; only load pygments when a block needs it.
+    import pygments
+    import pygments.formatters
+    import pygments.lexers
+
+    if self._lexer == 'guess':
+      lexer = pygments.lexers.guess_lexer(self._content)
+    else:
+      # Finding a lexer by name searches all of pygments' lexers.
+      lexer = _lexers.get(self._lexer)
+      if lexer is None:
+        lexer = pygments.lexers.get_lexer_by_name(self._lexer)
+        _lexers[self._lexer] = lexer
+
+    formatter = pygments.formatters.HtmlFormatter(linenos=self._linenos,
+                                                  cssclass='syntax')
+    return pygments.highlight(self._content, lexer, formatter)
+
 
 class HtmlEmitter(object):
   '''
   Generate HTML output for the document
   tree consisting of DocNodes.
   '''
+  # When set, every node is emitted through hook(kind, emit, node), which
+  # must return emit(node). The hook is a callable object such as
+  # instrument.KindTimer. Blocks reused from the FragmentCache are not
+  # emitted again; they go through the hook as kinds of their own.
+  hook = None
+
   def __init__(self, ds, root, omit_title=False, omit_summary=False):
     self._ds = ds
     self._level = 0
@@ -283,7 +472,25 @@ class HtmlEmitter(object):
       return node.content or ''
 
   def document_emit(self, node):
-    return self.emit_children(node)
+    return u''.join([self._emit_top(child) for child in node.children])
+
+  def _emit_top(self, node):
+    '''Emit a top-level node.'''
+    fragments = self._ds.fragments()
+    if fragments is None:
+      return self.emit_node(node)
+    return self._emit_block(fragments, node)
+
+  def _emit_block(self, fragments, node):
+    '''Emit a top-level node, reusing its cached HTML if possible.
+
+    Headers change the emitter's state, so they are always emitted.
+    '''
+    if (node.kind == 'header' or
+        (self._omit_summary and not self._seen_level2_header)):
+      return self.emit_node(node)
+    return fragments.html(self._ds, node, self._level, self.emit_node,
+                          self.hook)
 
   def text_emit(self, node):
     return html_escape(node.content)
@@ -291,13 +498,26 @@ class HtmlEmitter(object):
   def separator_emit(self, node):
     return u'<hr>'
 
+  def _split_tags(self, node, start, inside, end):
+    '''Put start and end tags around the HTML of a node, leaving out those
+    that belong to other pieces of a block cut while streaming (see
+    parse_blocks).'''
+    split = getattr(node, 'split', None)
+    if split in ('middle', 'last'):
+      start = u''
+    if split in ('first', 'middle'):
+      end = u''
+    return start + inside + end
+
   def paragraph_emit(self, node):
     inside = self.emit_children(node)
-    if inside:
+    start = u'<p>'
+    if inside and getattr(node, 'split', None) in (None, 'first'):
       s = inside.split(' ')
       if s[0].lower() in ('note:', 'tip:', 'important:', 'warning:'):
-        return u'<p class="%s">%s</p>\n' % (s[0].lower()[:-1], ' '.join(s[1:]))
-    return u'<p>%s</p>\n' % inside
+        start = u'<p class="%s">' % s[0].lower()[:-1]
+        inside = ' '.join(s[1:])
+    return self._split_tags(node, start, inside, u'</p>\n')
 
   def bullet_list_emit(self, node):
     if self._level:
@@ -317,7 +537,8 @@ class HtmlEmitter(object):
     return u'<li>%s</li>\n' % self.emit_children(node)
 
   def table_emit(self, node):
-    return u'<table>\n%s</table>\n' % self.emit_children(node)
+    return self._split_tags(node, u'<table>\n', self.emit_children(node),
+                            u'</table>\n')
 
   def table_row_emit(self, node):
     return u'<tr>%s</tr>\n' % self.emit_children(node)
@@ -360,11 +581,26 @@ class HtmlEmitter(object):
       inside = self.emit_children(node)
     return LinkNode(self._ds, node, inside).to_html()
 
+  def _size_attrs(self, target):
+    '''Get width and height attributes for a local image, if known.'''
+    sizes = self._ds.imageSizes()
+    size = sizes and sizes.size(target)
+    if not size:
+      return u''
+    return u' width="%d" height="%d"' % size
+
+  def _asset_url(self, target):
+    '''Get the URL of a local file, by its fingerprinted name if it has one.'''
+    assets = self._ds.assets()
+    if assets is not None:
+      target = assets.name(target)
+    return source_url(attr_escape(target))
+
   def image_emit(self, node):
     # FIXME(ms): this code is really ugly.
     target = node.content
     text = self.get_text(node)
-    m = ADDR_RE.match(target)
+    kind, _ = self._ds.links().classify(target)
 
     # pull class from text if possible
     if text.startswith('_') and text.endswith('_'):
@@ -380,8 +616,8 @@ class HtmlEmitter(object):
       css_class = None
     class_str = css_class and (' class="%s"' % css_class) or ''
 
-    if m:
-      if m.group('extern_addr'):
+    if kind != 'site':
+      if kind == 'extern':
         s = target.split("?", 2)
         if len(s) == 2:
           target, args = s
@@ -397,7 +633,7 @@ class HtmlEmitter(object):
         else:
           return u'<img src="%s"%s%s alt="%s" />' % (
             attr_escape(target), class_str, width_str, attr_escape(text))
-      elif m.group('intern_addr'):
+      elif kind == 'intern':
         s = target.split("?", 2)
         if len(s) == 2:
           target, args = s
@@ -408,14 +644,13 @@ class HtmlEmitter(object):
         if width_str:
           return (u'<a href="%s" class="lightbox">'
                   '<img src="%s"%s%s alt="%s" /></a>' %
-                  (source_url(attr_escape(target)),
-                   source_url(attr_escape(target)),
+                  (self._asset_url(target), self._asset_url(target),
                    class_str, width_str, attr_escape(text)))
         else:
-          return (u'<img src="%s"%s alt="%s" />' %
-                  (source_url(attr_escape(target)),
-                   class_str, attr_escape(text)))
-      elif m.group('inter_wiki'):
+          return (u'<img src="%s"%s%s alt="%s" />' %
+                  (self._asset_url(target),
+                   class_str, self._size_attrs(target), attr_escape(text)))
+      elif kind == 'interwiki':
         raise NotImplementedError
     return (u'<img src="%s"%s alt="%s" />' %
             (attr_escape(target), class_str, attr_escape(text)))
@@ -445,7 +680,9 @@ class HtmlEmitter(object):
       return u''
 
     emit = getattr(self, '%s_emit' % node.kind, self.default_emit)
-    return emit(node)
+    if self.hook is None:
+      return emit(node)
+    return self.hook(node.kind, emit, node)
 
   def emit(self):
     '''Emit the document represented by self.root DOM tree.'''
@@ -454,12 +691,37 @@ class HtmlEmitter(object):
       ret += u'</div>\n\n'
     return ret
 
+  def emit_blocks(self, nodes):
+    '''Emit a document given as its top-level nodes instead of self.root.
+
+    Nodes are emitted as they come, so they can be parsed while the
+    document is read; see DocumentSet.parseStream.
+
+    Args:
+      nodes: iterable of top-level DocNodes
+
+    Returns:
+      unicode HTML, as emit() gives for a root with these children
+    '''
+    parts = [self._emit_top(node) for node in nodes]
+    if self._level:
+      parts.append(u'</div>\n\n')
+    return u''.join(parts)
+
 
 class Parser(creole.Parser):
   '''Convenience Parser class.'''
   pass
 
 
+# Parser engines selectable with the 'parser' config setting. Both build the
+# same DocNode tree.
+PARSERS = {
+  'creole': Parser,
+  'scanner': scanner.Parser,
+}
+
+
 class TOC(object):
   class NodeList(list):
     level = 1
@@ -512,19 +774,18 @@ class TOC(object):
   def _to_html_rec(self, item, level_adjust=False):
     if item is None:
       return ''
-    level_comp = level_adjust and -1 or 0
-    item.level += level_comp
+    level = item.level + (level_adjust and -1 or 0)
     if type(item) == self.Node:
       return (u'%s<li><a href="#%s">%s</a>%s</li>\n' %
-              ('  ' * item.level,
+              ('  ' * level,
                header_short_name(item.title),
                item.title,
                self._to_html_rec(item.children, level_adjust)))
     elif type(item) == self.NodeList:
       return (u'\n%s<ol>\n%s%s</ol>\n' %
-              ('  ' * (item.level - 1),
+              ('  ' * (level - 1),
                u''.join([self._to_html_rec(x, level_adjust) for x in item]),
-               '  ' * (item.level - 1)))
+               '  ' * (level - 1)))
     else:
       raise TypeError
 
@@ -563,7 +824,13 @@ class TOC(object):
 
 class StructureExtractor(object):
   '''Extract structure information from a DocNode tree.'''
-  def __init__(self, root):
+  def __init__(self, root=None):
+    '''Constructor.
+
+    Args:
+      root: (optional) root DocNode of the document; without one, the
+        top-level nodes are passed to add() instead
+    '''
     self.title = None
     self.summary_root = creole.DocNode()
     self.summary_root.kind = 'document'
@@ -571,7 +838,19 @@ class StructureExtractor(object):
 
     self._seen_level2_header = False
     self._root = root
-    self._process()
+    if root is not None:
+      self._process()
+
+  def add(self, node):
+    '''Process a top-level node of a document that is read block by block.
+
+    Only the summary nodes and the TOC are kept.
+    '''
+    self._process_node(node)
+
+  def summary_complete(self):
+    '''Returns true once no further node can be part of the summary.'''
+    return self._seen_level2_header
 
   def _document_process(self, node):
     return self._process_children(node)
@@ -600,9 +879,375 @@ class StructureExtractor(object):
     self._process_node(self._root)
 
 
-class DocumentSet(object):
+# Length in characters past which an open table or paragraph of a streamed
+# document is cut into pieces; see scanner.stream_blocks.
+STREAM_CHUNK_LIMIT = 256 * 1024
+
+
+class _ChunkParser(object):
+  '''Parses the chunks of scanner.stream_blocks.
+
+  The pieces of a table or paragraph cut by stream_blocks are parsed on
+  their own, which gives the same rows and lines as parsing it whole, and
+  marked with a split attribute of 'first', 'middle' or 'last', so that the
+  emitter puts out its tags only once. A cut where inline markup is still
+  open would change the parse; the text is then kept and parsed along with
+  the next chunk instead.
+  '''
+  def __init__(self, parser):
+    self._parser = parser
+    self._kept = u''      # text of chunks whose cut was undone
+    self._retry = 0       # length of kept text worth trying to cut again
+    self._split = False   # whether the last chunk was cut
+
+  def parse(self, chunk, cut):
+    '''Parse a chunk.
+
+    Args:
+      chunk: unicode Creole source
+      cut: whether stream_blocks cut the chunk off inside a block
+
+    Returns:
+      list of top-level creole.DocNode objects, empty if the chunk is kept
+    '''
+    text = self._kept + chunk
+    if cut:
+      if len(text) < self._retry:
+        self._kept = text
+        return []
+      # Without the final newline, the parser is left inside the cut block,
+      # or deeper if inline markup is open.
+      parser = self._parser(text[:-1])
+      nodes = parser.parse().children
+      if not nodes or parser.cur is not nodes[-1]:
+        self._kept = text
+        self._retry = 2 * len(text)  # keeps the parsing linear
+        return []
+    else:
+      nodes = self._parser(text).parse().children
+    self._kept = u''
+    self._retry = 0
+    if self._split:
+      # The first node goes on with the block cut off the last chunk.
+      nodes[0].split = 'last'
+    if cut:
+      last = nodes[-1]
+      last.split = getattr(last, 'split', None) and 'middle' or 'first'
+    self._split = cut
+    return nodes
+
+
+def parse_blocks(pieces, parser, limit=STREAM_CHUNK_LIMIT):
+  '''Parse Creole source read in pieces, yielding its top-level nodes.
+
+  Each block is parsed as soon as the text after it can no longer change
+  it (see scanner.stream_blocks), so only the open block is held in memory.
+  A table or paragraph longer than the limit comes in pieces; see
+  _ChunkParser.
+
+  Args:
+    pieces: iterable of unicode strings whose concatenation is the source
+    parser: parser class, e.g. a value of PARSERS
+    limit: (optional) length in characters past which a block is cut
+
+  Yields:
+    top-level creole.DocNode objects, in document order
+  '''
+  chunks = _ChunkParser(parser)
+  for block, cut in scanner.stream_blocks(pieces, limit):
+    for node in chunks.parse(block, cut):
+      yield node
+
+
+class BlockCache(object):
+  '''Parsed blocks of Creole source, keyed by a digest of their text.
+
+  Documents are split into blocks that parse independently (see
+  scanner.split_blocks), so when a document is edited only its changed
+  blocks are parsed again. A DocumentSet starts a new generation of the
+  cache whenever it is refreshed.
+  '''
+  def __init__(self):
+    self._trees = GenerationalCache()
+    self._parsed = 0
+    self._reused = 0
+
+  def newGeneration(self):
+    self._trees.newGeneration()
+
+  def parse(self, text, parser):
+    '''Parse Creole source, reusing the trees of unchanged blocks.
+
+    Args:
+      text: unicode Creole source
+      parser: parser class, e.g. a value of PARSERS
+
+    Returns:
+      root creole.DocNode of the document
+    '''
+    root = creole.DocNode('document', None)
+    for block in scanner.split_blocks(text):
+      key = hashlib.md5(block.encode('utf-8')).digest()
+      tree = self._trees.get(key)
+      if tree is None:
+        tree = parser(block).parse()
+        self._trees.put(key, tree)
+        self._parsed += 1
+      else:
+        self._reused += 1
+      for node in tree.children:
+        node.parent = root
+      root.children.extend(tree.children)
+    return root
+
+  def stats(self):
+    '''Get the number of blocks parsed and reused so far.
+
+    Returns:
+      (parsed, reused) tuple
+    '''
+    return (self._parsed, self._reused)
+
+
+def _subtree_digest(node):
+  '''Get an MD5 digest of a DocNode subtree.'''
+  md5 = hashlib.md5()
+  def update(node):
+    md5.update(repr((node.kind, node.content, getattr(node, 'level', None),
+                     getattr(node, 'args', None), getattr(node, 'sect', None),
+                     getattr(node, 'split', None), len(node.children))))
+    for child in node.children:
+      update(child)
+  update(node)
+  return md5.digest()
+
+
+class FragmentCache(object):
+  '''Emitted HTML of top-level blocks.
+
+  Besides its subtree, a block's HTML depends on the emitter's section level
+  if it contains lists, the titles of the documents it links to and the
+  sizes and fingerprinted names of its local images; all of those are part
+  of the key. Generations are started as for BlockCache.
+  '''
   def __init__(self):
+    self._fragments = GenerationalCache()
+    self._hits = 0
+    self._misses = 0
+
+  def newGeneration(self):
+    self._fragments.newGeneration()
+
+  def _dependencies(self, node):
+    '''Get what the HTML of a block depends on besides the document set.
+
+    This only depends on the subtree, so it is memoized on the node.
+
+    Returns:
+      (digest, has_lists, link targets, image targets, image files) tuple;
+      image targets are those without a width, whose size is looked up
+    '''
+    try:
+      return node.fragment_info
+    except AttributeError:
+      pass
+    has_lists = False
+    links = []
+    images = []
+    files = []
+    stack = [node]
+    while stack:
+      cur = stack.pop()
+      if cur.kind in ('bullet_list', 'number_list'):
+        has_lists = True
+      elif cur.kind == 'link':
+        links.append(cur.content)
+      elif cur.kind == 'image':
+        if '?' not in cur.content:
+          images.append(cur.content)
+        files.append(cur.content.split('?', 2)[0])
+      stack.extend(cur.children)
+    node.fragment_info = (_subtree_digest(node), has_lists, links, images,
+                          files)
+    return node.fragment_info
+
+  def html(self, ds, node, level, emit, hook=None):
+    '''Get the HTML of a top-level block.
+
+    Args:
+      ds: DocumentSet the block's document belongs to
+      node: top-level DocNode
+      level: section level of the emitter
+      emit: function emitting the node on a cache miss
+      hook: (optional) emitter hook that cache hits are reported to, as
+        kind "<kind> (reused)"; see HtmlEmitter.hook
+
+    Returns:
+      unicode HTML
+    '''
+    digest, has_lists, links, images, files = self._dependencies(node)
+    resolver = ds.links()
+    titles = tuple([resolver.resolve(target).title for target in links
+                    if resolver.classify(target)[0] == 'intern'])
+    sizes = ds.imageSizes()
+    if sizes is not None:
+      sizes = tuple([sizes.size(target) for target in images
+                     if resolver.classify(target)[0] == 'intern'])
+    assets = ds.assets()
+    if assets is not None:
+      assets = tuple([assets.name(target) for target in files])
+    key = (digest, has_lists and level, titles, sizes, assets)
+
+    html = self._fragments.get(key)
+    if html is None:
+      html = emit(node)
+      self._fragments.put(key, html)
+      self._misses += 1
+    else:
+      self._hits += 1
+      if hook is not None:
+        hook('%s (reused)' % node.kind, lambda html: html, html)
+    return html
+
+  def stats(self):
+    '''Get the number of cache hits and misses so far.
+
+    Returns:
+      (hits, misses) tuple
+    '''
+    return (self._hits, self._misses)
+
+
+class PathNode(object):
+  '''Node of the path trie of a DocumentSet.
+
+  There is a node for every document name and for every prefix of one, each
+  holding the Document of that name or None.
+  '''
+  def __init__(self, parent, segment, name):
+    '''Constructor.
+
+    Args:
+      parent: parent PathNode, or None for the root
+      segment: last path segment of the name
+      name: document name, e.g. 'articles/irssi'
+    '''
+    self.parent = parent
+    self.segment = segment
+    self.name = name
+    self.document = None
+    self.children = {}  # path segment -> PathNode
+    self._sections = None
+
+  def title(self):
+    '''Get the title of the node's document, or its name if it has none.'''
+    if self.document is None:
+      return self.name
+    return self.document.title()
+
+  def sections(self):
+    '''Get the nearest documents below this node.
+
+    These are the documents of the child nodes, and for children without a
+    document the nearest documents below them, in path order. The list is
+    kept until a document below this node is added or removed.
+
+    Returns:
+      list of Document
+    '''
+    if self._sections is None:
+      sections = []
+      for segment in sorted(self.children):
+        child = self.children[segment]
+        if child.document is not None:
+          sections.append(child.document)
+        else:
+          sections.extend(child.sections())
+      self._sections = sections
+    return self._sections
+
+  def changed(self):
+    '''Forget the section listings of this node and its ancestors.'''
+    node = self
+    while node is not None:
+      node._sections = None
+      node = node.parent
+
+
+# Rough ratio of the memory held by a parsed document (source text, DocNode
+# tree and structure) to the length of its source.
+PARSED_SIZE_RATIO = 10
+
+
+class _UseOrder(object):
+  '''Names in order of their last use, in constant time per operation.
+
+  Each name maps to its link [previous, next, name] in a circular doubly
+  linked list around a sentinel link, from the least to the most recently
+  used name.
+  '''
+  def __init__(self):
+    self._sentinel = []
+    self._sentinel[:] = [self._sentinel, self._sentinel, None]
+    self._links = {}
+
+  def __len__(self):
+    return len(self._links)
+
+  def __contains__(self, name):
+    return name in self._links
+
+  def use(self, name):
+    '''Make a name the most recently used one, adding it if needed.'''
+    if name in self._links:
+      self.remove(name)
+    last = self._sentinel[0]
+    link = [last, self._sentinel, name]
+    last[1] = self._sentinel[0] = self._links[name] = link
+
+  def remove(self, name):
+    link = self._links.pop(name)
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def oldest(self):
+    '''Get the least recently used name.'''
+    return self._sentinel[1][2]
+
+
+class DocumentSet(object):
+  def __init__(self, interwiki=None, memory_budget=None, parser='creole',
+               block_cache=None, fragment_cache=None, stream_size=None):
+    '''Constructor.
+
+    Args:
+      interwiki: (optional) dict of site-specific interwiki keywords
+      memory_budget: (optional) approximate number of bytes that parsed
+        documents may hold before the least recently used ones are evicted;
+        None for no limit
+      parser: (optional) name of the parser engine, a key of PARSERS
+      block_cache: (optional) BlockCache for re-parsing edited documents
+        block by block
+      fragment_cache: (optional) FragmentCache for reusing the HTML of
+        unchanged blocks
+      stream_size: (optional) documents with sources larger than this many
+        bytes are parsed block by block as they are read, and never held
+        whole; None to always parse documents whole
+    '''
     self._map = {}
+    self._root = PathNode(None, '', '')
+    self._names = []  # sorted document names
+    self._parser = PARSERS[parser]
+    self._block_cache = block_cache
+    self._fragment_cache = fragment_cache
+    self._links = LinkResolver(self, interwiki)
+    self._memory_budget = memory_budget
+    self._stream_size = stream_size
+    self._parsed = _UseOrder()  # names of parsed documents
+    self._parsed_size = 0
+    self._evictions = 0
+    self._image_sizes = None
+    self._assets = None
 
   def contains(self, name):
     return (name in self._map)
@@ -613,7 +1258,155 @@ class DocumentSet(object):
     return self._map[name]
 
   def list(self):
-    return sorted(self._map.keys())
+    return list(self._names)
+
+  def _pathNode(self, name, create=False):
+    '''Find the trie node of a document name.
+
+    Args:
+      name: document name
+      create: (optional) create missing nodes on the path
+
+    Returns:
+      PathNode, or None if there is none and create is False
+    '''
+    node = self._root
+    if name == '':
+      return node
+    for segment in name.split('/'):
+      child = node.children.get(segment)
+      if child is None:
+        if not create:
+          return None
+        if node is self._root:
+          child_name = segment
+        else:
+          child_name = '%s/%s' % (node.name, segment)
+        child = PathNode(node, segment, child_name)
+        node.children[segment] = child
+      node = child
+    return node
+
+  def breadcrumbs(self, name):
+    '''Get the trail of documents leading to a document.
+
+    Args:
+      name: document name
+
+    Returns:
+      list of (name, title) for the root, each prefix of name and name
+      itself; prefixes that are not documents are titled by their names
+    '''
+    node = self._root
+    crumbs = [(node.name, node.title())]
+    if name == '':
+      return crumbs
+    segments = name.split('/')
+    for i, segment in enumerate(segments):
+      if node is not None:
+        node = node.children.get(segment)
+      if node is not None:
+        crumbs.append((node.name, node.title()))
+      else:
+        prefix = '/'.join(segments[:i + 1])
+        crumbs.append((prefix, prefix))
+    return crumbs
+
+  def sections(self, name):
+    '''Get the nearest documents below a document name.
+
+    Args:
+      name: document name, or a prefix of document names
+
+    Returns:
+      list of Document; see PathNode.sections()
+    '''
+    node = self._pathNode(name)
+    if node is None:
+      return []
+    return node.sections()
+
+  def links(self):
+    '''Get the LinkResolver for this document set.'''
+    return self._links
+
+  def parse(self, text):
+    '''Parse Creole source with the set's parser engine.
+
+    Returns:
+      root creole.DocNode of the document
+    '''
+    if self._block_cache is not None:
+      return self._block_cache.parse(text, self._parser)
+    return self._parser(text).parse()
+
+  def parseStream(self, pieces):
+    '''Parse Creole source read in pieces with the set's parser engine.
+
+    The block cache is not used, since it would keep every block.
+
+    Yields:
+      top-level creole.DocNode objects; see parse_blocks()
+    '''
+    return parse_blocks(pieces, self._parser)
+
+  def scanStream(self, pieces):
+    '''Extract the structure of Creole source read in pieces.
+
+    Blocks are parsed until the summary is complete; after that only the
+    headers are picked out of them, for the TOC.
+
+    Args:
+      pieces: iterable of unicode strings whose concatenation is the source
+
+    Returns:
+      StructureExtractor
+    '''
+    structure = StructureExtractor()
+    chunks = _ChunkParser(self._parser)
+    for block, cut in scanner.stream_blocks(pieces, STREAM_CHUNK_LIMIT):
+      if not structure.summary_complete():
+        for node in chunks.parse(block, cut):
+          structure.add(node)
+        continue
+      for level, text in scanner.scan_headers(block):
+        node = creole.DocNode('header', None, text)
+        node.level = level
+        structure.add(node)
+    return structure
+
+  def streams(self, file):
+    '''Returns true if a document file is too large to be parsed whole.'''
+    if self._stream_size is None:
+      return False
+    stamp = file.stamp()
+    if stamp is not None:
+      size = stamp[0]
+    else:
+      size = os.path.getsize(file.path())
+    return size > self._stream_size
+
+  def blockCache(self):
+    '''Get the BlockCache for parsed blocks, or None.'''
+    return self._block_cache
+
+  def fragments(self):
+    '''Get the FragmentCache for emitted blocks, or None.'''
+    return self._fragment_cache
+
+  def imageSizes(self):
+    '''Get the imagesize.ImageSizes of the site's images, or None.'''
+    return self._image_sizes
+
+  def setImageSizes(self, image_sizes):
+    self._image_sizes = image_sizes
+
+  def assets(self):
+    '''Get the assets.AssetManifest of the site's static files, or None.'''
+    return self._assets
+
+  def setAssets(self, manifest):
+    self._assets = manifest
 
   def isDocument(self, file):
     '''Returns true if the given file is a document.'''
@@ -635,8 +1428,114 @@ class DocumentSet(object):
 
     doc = Document(self, docname, file)
     self._map[docname] = doc
+    node = self._pathNode(docname, create=True)
+    if node.document is None:
+      bisect.insort(self._names, docname)
+    node.document = doc
+    node.changed()
     return doc
 
+  def documentRemove(self, name):
+    '''Remove a document from the set.'''
+    doc = self._map.pop(name, None)
+    if doc is None:
+      return
+    if name in self._parsed:
+      self._parsed_size -= doc.parsedSize()
+      self._parsed.remove(name)
+
+    del self._names[bisect.bisect_left(self._names, name)]
+    node = self._pathNode(name)
+    node.document = None
+    node.changed()
+    # Drop nodes that no longer lead to a document.
+    while (node.parent is not None and node.document is None and
+           not node.children):
+      del node.parent.children[node.segment]
+      node = node.parent
+
+  def refresh(self, fs, changed):
+    '''Bring the set up to date after its filesystem was rescanned.
+
+    Documents whose files changed are replaced; the others keep their parsed
+    trees. Resolved links and rendered summaries may refer to titles of
+    changed documents, so they are dropped.
+
+    Args:
+      fs: filesystem.Filesystem
+      changed: set of file names that were added, removed or changed
+    '''
+    if not changed:
+      return
+    if self._block_cache is not None:
+      self._block_cache.newGeneration()
+    if self._fragment_cache is not None:
+      self._fragment_cache.newGeneration()
+    for name, doc in self._map.items():
+      if doc.file().name() in changed:
+        self.documentRemove(name)
+    for filename in changed:
+      file = fs.file(filename)
+      if file is not None and self.isDocument(file):
+        self.documentNew(file)
+
+    self._links.invalidate()
+    for doc in self._map.itervalues():
+      doc.forgetRendered()
+
+  def titleIndex(self):
+    '''Get the titles of all documents, parsing them as needed.
+
+    Returns:
+      dict of document name -> [source digest, title]
+    '''
+    index = {}
+    for name, doc in self._map.iteritems():
+      index[name] = [doc.file().digest(), doc.title()]
+    return index
+
+  def loadTitleIndex(self, index):
+    '''Seed document titles from a title index.
+
+    Titles are only used for documents whose source digest matches, so a
+    stale index costs parsing, not wrong output.
+
+    Args:
+      index: dict as returned by titleIndex()
+    '''
+    for name, (digest, title) in index.iteritems():
+      doc = self._map.get(name)
+      if doc is not None and doc.file().digest() == digest:
+        doc.seedTitle(title)
+
+  def documentUsed(self, doc):
+    '''Record a use of a parsed document.
+
+    Parsed documents are kept in an LRU. When their estimated size exceeds
+    the memory budget, the least recently used ones are evicted; they keep
+    their metadata and re-parse on demand.
+
+    Args:
+      doc: Document that has been parsed
+    '''
+    name = doc.name()
+    if name not in self._parsed:
+      self._parsed_size += doc.parsedSize()
+    self._parsed.use(name)
+
+    if self._memory_budget is None:
+      return
+    while self._parsed_size > self._memory_budget and len(self._parsed) > 1:
+      victim = self._parsed.oldest()
+      self._parsed_size -= self._map[victim].parsedSize()
+      self._parsed.remove(victim)
+      self._map[victim].evict()
+      self._evictions += 1
+
+  def evictions(self):
+    '''Get the number of parsed documents evicted so far.'''
+    return self._evictions
+
 
 class Document(object):
   def __init__(self, ds, name, file):
@@ -650,19 +1549,29 @@ class Document(object):
     self._ds = ds
     self._name = name
     self._file = file
+    self._streamed = ds.streams(file)
+    self._content = None
     self._document = None
     self._structure = None
     self._exists = True
 
+    # Metadata kept when the parsed document is evicted.
+    self._title = None
+    self._toc = None
+    self._summary = None
+    self._summary_root = None  # the summary's nodes, once evicted
+
   def __repr__(self):
     return '<Document "%s">' % self.name()
 
   def _parse(self):
+    if self._streamed:
+      self._scan()
+      return
+
     start = time.time()
-    self._content = self._file.content()
-    if type(self._content) != unicode:
-      self._content = unicode(self._content, 'utf-8', 'ignore')
-    self._document = Parser(self._content).parse()
+    self._content = self._file.text()
+    self._document = self._ds.parse(self._content)
     logging.debug('Done parsing. Elapsed: %.3fs' % (time.time() - start))
 
     start = time.time()
@@ -670,52 +1579,120 @@ class Document(object):
     logging.debug('Done extracting structure. Elapsed: %.3fs' %
                   (time.time() - start))
 
+    self._title = self._structure.title or os.path.basename(self.name())
+    if self._toc is None:
+      self._toc = self._structure.toc
+    self._ds.documentUsed(self)
+
+  def _scan(self):
+    '''Extract the structure of a streamed document, block by block.'''
+    start = time.time()
+    structure = self._ds.scanStream(self._file.textChunks())
+    logging.debug('Done scanning structure. Elapsed: %.3fs' %
+                  (time.time() - start))
+
+    self._structure = structure
+    self._title = structure.title or os.path.basename(self.name())
+    if self._toc is None:
+      self._toc = structure.toc
+
+  def _use(self):
+    '''Parse the document if necessary and mark it as recently used.'''
+    if self._structure is None:
+      self._parse()
+    elif not self._streamed:
+      self._ds.documentUsed(self)
+
+  def evict(self):
+    '''Drop the parsed document, keeping only its metadata.
+
+    The nodes of the summary are kept, so that it can be rendered again
+    without parsing the document. Its HTML is not rendered here, since that
+    may parse the documents it links to while the set is evicting.
+    '''
+    if self._structure is not None and self._summary_root is None:
+      self._summary_root = self._structure.summary_root
+      for node in self._summary_root.children:
+        node.parent = self._summary_root  # let go of the rest of the tree
+    self._content = None
+    self._document = None
+    self._structure = None
+
+  def forgetRendered(self):
+    '''Drop rendered HTML that may depend on other documents.'''
+    self._summary = None
+
+  def parsedSize(self):
+    '''Get the estimated memory held by the parsed document, in bytes.'''
+    if self._content is None:
+      return 0
+    return len(self._content) * PARSED_SIZE_RATIO
+
   def name(self):
     return self._name
 
-  def title(self):
-    # check local structure first
-    if self._structure:
-      return self._structure.title or os.path.basename(self.name())
+  def file(self):
+    return self._file
 
-    self._parse()
-    return self._structure.title or os.path.basename(self.name())
+  def tree(self):
+    '''Get the parsed DocNode tree of the document.
 
-  def to_html(self):
-    if not self._document or not self._structure:
+    A streamed document is parsed whole for this, and the tree is not kept;
+    blocks() gives its nodes without holding them all.
+    '''
+    if self._streamed:
+      return self._ds.parse(self._file.text())
+    self._use()
+    return self._document
+
+  def blocks(self):
+    '''Get the top-level DocNodes of the document.
+
+    Returns:
+      iterable of DocNode; for a streamed document, a generator that reads
+      and parses the source as it goes
+    '''
+    if self._streamed:
+      return self._ds.parseStream(self._file.textChunks())
+    return self.tree().children
+
+  def seedTitle(self, title):
+    '''Set the title without parsing, e.g. from a title index.'''
+    if self._title is None:
+      self._title = title
+
+  def title(self):
+    if self._title is None:
       self._parse()
+    return self._title
+
+  def to_html(self):
+    if self._streamed:
+      emitter = HtmlEmitter(self._ds, None, omit_title=True, omit_summary=True)
+      return emitter.emit_blocks(self.blocks())
+    self._use()
     emitter = HtmlEmitter(self._ds, self._document,
                           omit_title=True, omit_summary=True)
-    return emitter.emit().encode('utf-8', 'ignore')
+    return emitter.emit()
 
   def summary(self):
-    if not self._structure:
-      self._parse()
-    emitter = HtmlEmitter(self._ds, self._structure.summary_root)
-    return emitter.emit().encode('utf-8', 'ignore')
+    if self._summary is None:
+      root = self._summary_root
+      if root is None:
+        self._use()
+        root = self._structure.summary_root
+      self._summary = HtmlEmitter(self._ds, root).emit()
+    return self._summary
 
   def toc(self):
-    if not self._structure:
+    if self._toc is None:
       self._parse()
-    return self._structure.toc
+    return self._toc
 
   def breadcrumbs(self):
-    bc = []
-
-    name = self.name()
-    if name != '':
-      name = '/%s' % name
-
-    bc_split = name.split('/')
-
-    for i, segment in enumerate(bc_split):
-      bc_docname = '/'.join(bc_split[1:(i + 1)])
-
-      if self._ds.contains(bc_docname):
-        bc_title = self._ds.document(bc_docname).title()
-      else:
-        bc_title = bc_docname
-
-      bc.append((bc_docname, bc_title))
+    return self._ds.breadcrumbs(self.name())
 
-    return bc
\ No newline at end of file
+  def sections(self):
+    '''Get the nearest documents below this one, e.g. for section index
+    pages.'''
+    return self._ds.sections(self.name())
\ No newline at end of file
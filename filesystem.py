@@ -1,13 +1,188 @@
+import codecs
+import hashlib
 import logging
 import os
+import re
+import stat
 import time
 
 
+# Number of bytes read at a time when files are read in pieces.
+READ_CHUNK_SIZE = 65536
+
+
+def file_digest(path):
+  '''Get the MD5 hex digest of a file's content.
+
+  Args:
+    path: full filesystem path
+
+  Returns:
+    hex digest string
+  '''
+  md5 = hashlib.md5()
+  fh = open(path, 'rb')
+  while True:
+    data = fh.read(READ_CHUNK_SIZE)
+    if not data:
+      break
+    md5.update(data)
+  fh.close()
+  return md5.hexdigest()
+
+
+_GLOB_CHARS_RE = re.compile(r'[*?[]')
+
+
+def _anchored(pattern):
+  '''Check whether a glob pattern only matches paths from the root.'''
+  pattern = pattern.rstrip('/')
+  return ('/' in pattern or _GLOB_CHARS_RE.search(pattern) is None)
+
+
+def glob_to_regex(pattern):
+  '''Translate a glob pattern into a regular expression for relative paths.
+
+  '*' and '?' match within one path segment and '**' matches any number of
+  segments; a trailing '/**' also matches the directory itself. A pattern
+  that contains a '/' is anchored at the root, and so is a plain path
+  without wildcards, which matches just that path as exclude always did. A
+  pattern with wildcards and no '/' matches a name at any depth, e.g.
+  '*.swp'.
+
+  Args:
+    pattern: glob pattern, with '/' separating segments
+
+  Returns:
+    regular expression string matching whole paths
+  '''
+  prefix = ''
+  if not _anchored(pattern):
+    prefix = '(?:.*/)?'
+  return prefix + _translate(pattern.rstrip('/').lstrip('/'))
+
+
+def _translate(pattern):
+  '''Translate the wildcards of a glob pattern; see glob_to_regex.'''
+  parts = []
+  i = 0
+  n = len(pattern)
+  while i < n:
+    c = pattern[i]
+    i += 1
+    if c == '/' and pattern[i:] == '**':
+      parts.append('(?:/.*)?')
+      break
+    elif c == '*':
+      if pattern.startswith('*', i):
+        i += 1
+        if pattern.startswith('/', i):
+          i += 1
+          parts.append('(?:.*/)?')
+        else:
+          parts.append('.*')
+      else:
+        parts.append('[^/]*')
+    elif c == '?':
+      parts.append('[^/]')
+    elif c == '[':
+      end = pattern.find(']', i + 1)
+      if end < 0:
+        parts.append('\\[')
+      else:
+        chars = pattern[i:end].replace('\\', '\\\\')
+        if chars.startswith('!'):
+          chars = '^' + chars[1:]
+        parts.append('[%s]' % chars)
+        i = end + 1
+    else:
+      parts.append(re.escape(c))
+  return ''.join(parts)
+
+
+def escape_pattern(path):
+  '''Escape a path so that it only matches itself as a glob pattern.'''
+  return re.sub(r'([*?[])', r'[\1]', path)
+
+
+class PathPatterns(object):
+  '''A set of glob patterns, compiled into one regular expression.'''
+  def __init__(self, patterns=None):
+    '''Constructor.
+
+    Args:
+      patterns: (optional) iterable of glob patterns; see glob_to_regex
+    '''
+    self._patterns = sorted(set(patterns or []))
+    self._re = None
+    if self._patterns:
+      self._re = re.compile('^(?:%s)$' % '|'.join(
+        ['(?:%s)' % glob_to_regex(p) for p in self._patterns]))
+
+    # Segments of the anchored patterns, each as a compiled regular
+    # expression or None for a segment with '**'; see matchesBelow.
+    self._anywhere = False
+    self._segments = []
+    for pattern in self._patterns:
+      if not _anchored(pattern):
+        self._anywhere = True
+        continue
+      segments = []
+      for segment in pattern.strip('/').split('/'):
+        if '**' in segment:
+          segments.append(None)
+        else:
+          segments.append(re.compile('^%s$' % _translate(segment)))
+      self._segments.append(segments)
+
+  def __repr__(self):
+    return '<filesystem.PathPatterns %r>' % self._patterns
+
+  def patterns(self):
+    return self._patterns
+
+  def matches(self, name):
+    '''Check whether a relative path matches any of the patterns.'''
+    if self._re is None:
+      return False
+    if os.sep != '/':
+      name = name.replace(os.sep, '/')
+    return self._re.match(name) is not None
+
+  def matchesBelow(self, dirname):
+    '''Check whether any pattern may match a path inside a directory.
+
+    This may give false positives, but never false negatives.
+
+    Args:
+      dirname: relative path of the directory
+    '''
+    if self._anywhere:
+      return True
+    if os.sep != '/':
+      dirname = dirname.replace(os.sep, '/')
+    names = dirname.split('/')
+    for segments in self._segments:
+      for i, name in enumerate(names):
+        if i == len(segments):
+          break  # the pattern only matches paths above
+        if segments[i] is None:
+          return True  # '**' may match anything below
+        if not segments[i].match(name):
+          break
+      else:
+        if len(segments) > len(names):
+          return True
+    return False
+
+
 class File(object):
   '''Class representing a file on a filesystem.'''
-  def __init__(self, name, path):
+  def __init__(self, name, path, stamp=None):
     self._name = name
     self._path = path
+    self._stamp = stamp
+    self._digest = None
 
   def __repr__(self):
     return '<filesystem.File "%s">' % self._name
@@ -15,18 +190,91 @@ class File(object):
   def name(self):
     return self._name
 
+  def path(self):
+    return self._path
+
+  def mtime(self):
+    return os.path.getmtime(self._path)
+
+  def stamp(self):
+    '''Get the (size, mtime) of the file as of the filesystem scan.'''
+    return self._stamp
+
   def content(self):
     fh = open(self._path, 'r')
     content = fh.read()
     fh.close()
     return content
 
+  def text(self, encoding='utf-8'):
+    '''Get the file content decoded to unicode.
+
+    Raises:
+      ValueError: the content is not valid in the given encoding
+    '''
+    try:
+      return unicode(self.content(), encoding)
+    except UnicodeDecodeError, e:
+      raise ValueError('%s is not valid %s: %s' % (self._name, encoding, e))
+
+  def textChunks(self, size=READ_CHUNK_SIZE, encoding='utf-8'):
+    '''Read the file decoded to unicode, a piece at a time.
+
+    Args:
+      size: (optional) number of bytes to read at a time
+      encoding: (optional) encoding of the file
+
+    Yields:
+      unicode strings whose concatenation is text()
+
+    Raises:
+      ValueError: the content is not valid in the given encoding
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)()
+    fh = open(self._path, 'r')
+    try:
+      while True:
+        data = fh.read(size)
+        try:
+          text = decoder.decode(data, not data)
+        except UnicodeDecodeError, e:
+          raise ValueError('%s is not valid %s: %s' %
+                           (self._name, encoding, e))
+        if text:
+          yield text
+        if not data:
+          return
+    finally:
+      fh.close()
+
+  def digest(self):
+    '''Get the MD5 hex digest of the file content.
+
+    The digest is computed on first use and cached on the File.
+
+    Returns:
+      hex digest string
+    '''
+    if self._digest is None:
+      self._digest = file_digest(self._path)
+    return self._digest
+
 
 class Filesystem(object):
-  def __init__(self, root, exclude=None):
+  def __init__(self, root, exclude=None, include=None):
+    '''Constructor.
+
+    Args:
+      root: root directory of the source tree
+      exclude: (optional) glob patterns of paths to leave out, with
+        everything inside excluded directories; see glob_to_regex
+      include: (optional) glob patterns of paths to keep even though they
+        or a directory they are in match an exclude pattern
+    '''
     self._root = os.path.normpath(os.path.abspath(root))
     self._map = {}
-    self._exclude = exclude if exclude else set()
+    self._exclude = PathPatterns(exclude)
+    self._include = PathPatterns(include)
     self._fillMap()
 
   def exists(self, name):
@@ -40,28 +288,67 @@ class Filesystem(object):
   def list(self):
     return sorted(self._map.keys())
 
-  def _fillMap(self):
-    def visit(_, dirname, names):
-      # Find included paths.
-      paths = []
-      bad_names = []
-      for name in names:
-        path = os.path.join(dirname, name)
-        path = os.path.normpath(os.path.abspath(path))
+  def refresh(self):
+    '''Rescan the filesystem, keeping the File objects of unchanged files.
 
-        if os.path.relpath(path, self._root) not in self._exclude:
-          paths.append((name, path))
-        else:
-          bad_names.append(name)
+    Returns:
+      set of names of files that were added, removed or changed
+    '''
+    old_map = self._map
+    self._map = {}
+    self._fillMap()
 
-      # Modify names in place to avoid walking excluded paths.
-      for name in bad_names:
-        names.remove(name)
+    changed = set()
+    for name, file in self._map.iteritems():
+      old_file = old_map.get(name)
+      if old_file is not None and old_file.stamp() == file.stamp():
+        self._map[name] = old_file  # keeps its cached digest
+      else:
+        changed.add(name)
+    for name in old_map:
+      if name not in self._map:
+        changed.add(name)
+    return changed
 
-      for name, path in paths:
-        if os.path.isfile(path):
-          name = os.path.relpath(path, self._root)
-          # Add all files to internal map, keyed by their relative path name.
-          self._map[name] = File(name, path)
+  def _excluded(self, name, in_excluded):
+    '''Check whether a path is left out.
+
+    Args:
+      name: relative path
+      in_excluded: whether the path is inside an excluded directory
+    '''
+    return ((in_excluded or self._exclude.matches(name)) and
+            not self._include.matches(name))
 
-    os.path.walk(self._root, visit, None)
\ No newline at end of file
+  def _fillMap(self):
+    # Walk the tree with relative names built along the way. Excluded
+    # directories are skipped before they are listed, unless an include
+    # pattern may match inside them; like os.path.walk, symlinks to
+    # directories are not followed.
+    dirs = [('', self._root, False)]
+    while dirs:
+      dirname, dirpath, in_excluded = dirs.pop()
+      try:
+        names = os.listdir(dirpath)
+      except OSError:
+        continue
+      for name in names:
+        if dirname:
+          name = os.path.join(dirname, name)
+        excluded = self._excluded(name, in_excluded)
+        path = os.path.join(self._root, name)
+        try:
+          st = os.lstat(path)
+          if stat.S_ISLNK(st.st_mode):
+            st = os.stat(path)
+          elif stat.S_ISDIR(st.st_mode):
+            if not excluded or self._include.matchesBelow(name):
+              dirs.append((name, path, excluded))
+            continue
+        except OSError:
+          continue
+        if excluded:
+          continue
+        if stat.S_ISREG(st.st_mode):
+          # Add all files to internal map, keyed by their relative path name.
+          self._map[name] = File(name, path, (st.st_size, st.st_mtime))
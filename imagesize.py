@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import Queue
+import struct
+import threading
+
+
+# Extensions of image files whose sizes are extracted.
+IMAGE_EXTENSIONS = ('.png', '.gif', '.jpg', '.jpeg')
+
+# JPEG start-of-frame markers, which carry the image size.
+_JPEG_SOF = (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+             0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf)
+
+
+def _jpeg_size(fh):
+  fh.seek(2)
+  while True:
+    marker = fh.read(2)
+    if len(marker) != 2 or marker[0] != '\xff':
+      return None
+    code = ord(marker[1])
+    if code == 0xff:  # fill byte
+      fh.seek(-1, os.SEEK_CUR)
+      continue
+    if code == 0x01 or 0xd0 <= code <= 0xd7:  # markers without a segment
+      continue
+    length = fh.read(2)
+    if len(length) != 2:
+      return None
+    length = struct.unpack('>H', length)[0]
+    if code in _JPEG_SOF:
+      data = fh.read(5)
+      if len(data) != 5:
+        return None
+      height, width = struct.unpack('>xHH', data)
+      return (width, height)
+    fh.seek(length - 2, os.SEEK_CUR)
+
+
+def image_size(fh):
+  '''Read the intrinsic size of a PNG, GIF or JPEG image from its header.
+
+  Args:
+    fh: image file opened in binary mode
+
+  Returns:
+    (width, height) tuple, or None if the format is not recognized
+  '''
+  head = fh.read(26)
+  if head.startswith('\x89PNG\r\n\x1a\n') and head[12:16] == 'IHDR':
+    return struct.unpack('>II', head[16:24])
+  if head[:6] in ('GIF87a', 'GIF89a') and len(head) >= 10:
+    return struct.unpack('<HH', head[6:10])
+  if head.startswith('\xff\xd8'):
+    return _jpeg_size(fh)
+  return None
+
+
+class ImageSizes(object):
+  '''Sizes of a site's images, extracted by a pool of background threads.
+
+  Sizes are cached by the digest of the image file and saved between builds,
+  so an image is only read again when its content changes.
+  '''
+  def __init__(self, cache_path=None, workers=4):
+    '''Constructor.
+
+    Args:
+      cache_path: (optional) path of the saved size cache
+      workers: number of extraction threads
+    '''
+    self._cache_path = cache_path
+    self._cache = {}  # digest -> [width, height] or None
+    self._workers = workers
+    self._entries = {}  # file name -> (threading.Event, [size, digest])
+    self._lock = threading.Lock()
+
+    if cache_path and os.path.isfile(cache_path):
+      try:
+        fh = open(cache_path, 'r')
+        self._cache = json.load(fh)
+        fh.close()
+      except ValueError, e:
+        logging.warning('Ignoring bad image size cache: %s' % e)
+
+  def start(self, files):
+    '''Start extracting the sizes of image files in the background.
+
+    Args:
+      files: list of filesystem.File; non-image files are ignored
+    '''
+    queue = Queue.Queue()
+    for file in files:
+      if os.path.splitext(file.name())[1].lower() in IMAGE_EXTENSIONS:
+        self._entries[file.name()] = (threading.Event(), [None, None])
+        queue.put(file)
+
+    def worker():
+      while True:
+        try:
+          file = queue.get_nowait()
+        except Queue.Empty:
+          return
+        event, result = self._entries[file.name()]
+        # Whatever happens, the event is set and the worker goes on with
+        # the next file, so that size() and save() never wait forever.
+        try:
+          try:
+            result[1] = file.digest()
+            result[0] = self._extract(file, result[1])
+          except Exception, e:
+            logging.warning('Cannot read size of %s: %s' % (file.name(), e))
+            result[0] = None
+        finally:
+          event.set()
+
+    for _ in xrange(min(self._workers, queue.qsize())):
+      thread = threading.Thread(target=worker)
+      thread.setDaemon(True)
+      thread.start()
+
+  def _extract(self, file, digest):
+    with self._lock:
+      if digest in self._cache:
+        size = self._cache[digest]
+        return size and tuple(size)
+
+    try:
+      fh = open(file.path(), 'rb')
+      try:
+        size = image_size(fh)
+      finally:
+        fh.close()
+    except (IOError, struct.error), e:
+      logging.warning('Cannot read size of %s: %s' % (file.name(), e))
+      size = None
+
+    with self._lock:
+      self._cache[digest] = size and list(size)
+    return size
+
+  def size(self, name):
+    '''Get the size of an image, waiting for its extraction to finish.
+
+    Args:
+      name: file name relative to the site root
+
+    Returns:
+      (width, height) tuple, or None if unknown
+    '''
+    entry = self._entries.get(name)
+    if entry is None:
+      return None
+    event, result = entry
+    event.wait()
+    return result[0]
+
+  def save(self):
+    '''Save the size cache, keeping only the images seen in this build.'''
+    if not self._cache_path:
+      return
+    live = {}
+    for name, (event, result) in self._entries.iteritems():
+      event.wait()
+      size, digest = result
+      if digest is not None:
+        live[digest] = size and list(size)
+    if not live and not os.path.isfile(self._cache_path):
+      return  # nothing to remember; don't create the cache directory for it
+    cache_dir = os.path.dirname(self._cache_path)
+    if cache_dir and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    temp_path = '%s~' % self._cache_path
+    fh = open(temp_path, 'w')
+    json.dump(live, fh, separators=(',', ':'))
+    fh.close()
+    os.rename(temp_path, self._cache_path)
@@ -0,0 +1,111 @@
+import __builtin__
+import sys
+import time
+
+
+class ImportTimer(object):
+  '''Times the modules imported while installed, like python -X importtime.
+
+  Each import that loads new modules is recorded with its own time and its
+  cumulative time including nested imports.
+  '''
+  def __init__(self):
+    self._import = None
+    self._records = []  # (depth, name, self seconds, cumulative seconds)
+    self._depth = 0
+    self._nested = 0.0
+
+  def install(self):
+    if self._import is None:
+      self._import = __builtin__.__import__
+      __builtin__.__import__ = self._timed_import
+
+  def uninstall(self):
+    if self._import is not None:
+      __builtin__.__import__ = self._import
+      self._import = None
+
+  def _timed_import(self, name, *args, **kwargs):
+    modules = len(sys.modules)
+    nested = self._nested
+    self._nested = 0.0
+    self._depth += 1
+    start = time.time()
+    try:
+      return self._import(name, *args, **kwargs)
+    finally:
+      elapsed = time.time() - start
+      self._depth -= 1
+      if len(sys.modules) != modules:
+        self._records.append((self._depth, name, elapsed - self._nested,
+                              elapsed))
+      self._nested = nested + elapsed
+
+  def total(self):
+    '''Get the time spent in top-level imports, in seconds.'''
+    return sum([r[3] for r in self._records if r[0] == 0])
+
+  def report(self):
+    '''Format the recorded imports in the order they completed.
+
+    Returns:
+      list of lines
+    '''
+    lines = ['import time: self [us] | cumulative | imported package']
+    for depth, name, self_time, cumulative in self._records:
+      lines.append('import time: %9d | %10d | %s%s' %
+                   (self_time * 1e6, cumulative * 1e6, '  ' * depth, name))
+    return lines
+
+
+class KindTimer(object):
+  '''Counts and times calls by kind, such as emitted node kinds.
+
+  An instance is a hook for document.HtmlEmitter and creole.Parser: it is
+  called as timer(kind, fn, arg) and returns fn(arg). Calls nest (emitting
+  a list emits its items), so each kind is charged its self time, without
+  the time of the calls nested in it.
+  '''
+  def __init__(self):
+    self._counts = {}
+    self._times = {}  # kind -> self seconds
+    self._nested = 0.0
+
+  def __call__(self, kind, fn, arg):
+    nested = self._nested
+    self._nested = 0.0
+    start = time.time()
+    try:
+      return fn(arg)
+    finally:
+      elapsed = time.time() - start
+      self._counts[kind] = self._counts.get(kind, 0) + 1
+      self._times[kind] = self._times.get(kind, 0.0) + elapsed - self._nested
+      self._nested = nested + elapsed
+
+  def total(self):
+    '''Get the time spent in all calls, in seconds.'''
+    return sum(self._times.values())
+
+  def report(self):
+    '''Format the counts and self times, slowest kind first.
+
+    Returns:
+      list of lines
+    '''
+    total = self.total() or 1.0
+    lines = ['%-20s %9s %10s %6s' % ('kind', 'count', 'self [ms]', 'share')]
+    for kind in sorted(self._times, key=self._times.get, reverse=True):
+      lines.append('%-20s %9d %10.1f %5.1f%%' % (
+        kind, self._counts[kind], self._times[kind] * 1e3,
+        100.0 * self._times[kind] / total))
+    return lines
+
+
+# Shared timer, installed by infmx --profile.
+import_timer = ImportTimer()
+
+# Shared timers of emitted node kinds and of the parser rules that matched,
+# installed as hooks by infmx --profile or the "profile" setting.
+emit_timer = KindTimer()
+parse_timer = KindTimer()
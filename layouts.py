@@ -0,0 +1,193 @@
+'''Page layouts: the Django templates in a site's _layouts directory.
+
+Django settings are global to the process, so Django is configured once,
+with LayoutLoader as its only template loader. The loader looks templates up
+in the _layouts directory of the site whose pages are being rendered, so
+several sites can be built in one process. Compiled templates are cached by
+the content of the whole _layouts directory and shared by every site whose
+layouts are the same.
+
+Layouts refer to static files with {% asset "css/site.css" %}, which gives
+the URL of the file's fingerprinted copy if the site has one.
+'''
+import hashlib
+import os
+
+import filesystem
+
+
+# Compiled templates, keyed by (digest of a _layouts directory, name).
+_templates = {}
+
+# Layouts objects by directory.
+_directories = {}
+
+# Layouts of the site whose templates are being compiled or rendered.
+_active = [None]
+
+
+def configure():
+  '''Configure Django to load templates through LayoutLoader.'''
+  import django.conf
+  if not django.conf.settings.configured:
+    django.conf.settings.configure(
+      TEMPLATE_LOADERS=('layouts.LayoutLoader',))
+    import django.template
+    library = django.template.Library()
+    library.simple_tag(asset_tag, takes_context=True, name='asset')
+    django.template.builtins.append(library)
+
+
+def asset_tag(context, name):
+  '''Get the URL of a static file; the {% asset %} tag.
+
+  Args:
+    context: template context; its "assets" variable is the
+      assets.AssetManifest of the site, or None
+    name: file name relative to the site root
+  '''
+  import document
+  assets = context.get('assets')
+  if assets is not None:
+    name = assets.name(name)
+  return document.source_url(name)
+
+
+def for_directory(path):
+  '''Get the Layouts of a _layouts directory, up to date with its files.
+
+  Args:
+    path: full filesystem path of the directory
+
+  Returns:
+    Layouts
+  '''
+  layouts = _directories.get(path)
+  if layouts is None:
+    layouts = Layouts(path)
+    _directories[path] = layouts
+  layouts.refresh()
+  return layouts
+
+
+class Layouts(object):
+  '''The templates in one _layouts directory.'''
+  def __init__(self, path):
+    '''Constructor.
+
+    Args:
+      path: full filesystem path of the directory
+    '''
+    self._path = path
+    self._stamp = None
+    self._digest = None
+
+  def __repr__(self):
+    return '<layouts.Layouts "%s">' % self._path
+
+  def path(self):
+    return self._path
+
+  def refresh(self):
+    '''Recompute the content digest of the directory if a file changed.'''
+    stamp = []
+    for dirpath, dirnames, filenames in os.walk(self._path):
+      for name in filenames:
+        path = os.path.join(dirpath, name)
+        stamp.append((path, os.path.getmtime(path)))
+    stamp.sort()
+    if stamp == self._stamp:
+      return
+
+    md5 = hashlib.md5()
+    for path, _ in stamp:
+      md5.update(repr((os.path.relpath(path, self._path),
+                       filesystem.file_digest(path))))
+    self._stamp = stamp
+    self._digest = md5.hexdigest()
+
+  def source(self, name):
+    '''Get the source of a template.
+
+    Raises:
+      django.template.TemplateDoesNotExist: there is no such template
+    '''
+    path = os.path.join(self._path, name)
+    if not os.path.isfile(path):
+      import django.template
+      raise django.template.TemplateDoesNotExist(name)
+    fh = open(path, 'r')
+    source = fh.read()
+    fh.close()
+    return unicode(source, 'utf-8')
+
+  def template(self, name):
+    '''Get a compiled template, compiling it on first use.
+
+    Raises:
+      django.template.TemplateDoesNotExist: there is no such template
+    '''
+    key = (self._digest, name)
+    template = _templates.get(key)
+    if template is None:
+      import django.template
+      import django.template.loader  # registers {% extends %} and friends
+      source = self.source(name)
+      # Included templates are loaded while compiling.
+      previous = _active[0]
+      _active[0] = self
+      try:
+        template = django.template.Template(source, None, name)
+      finally:
+        _active[0] = previous
+      _templates[key] = template
+    return template
+
+  def render(self, name, values):
+    '''Render a template.
+
+    Args:
+      name: template name, e.g. 'index.html'
+      values: dict of template variables
+
+    Returns:
+      unicode
+    '''
+    import django.template
+    template = self.template(name)
+    # Parent templates are loaded while rendering.
+    previous = _active[0]
+    _active[0] = self
+    try:
+      return template.render(django.template.Context(values))
+    finally:
+      _active[0] = previous
+
+
+class LayoutLoader(object):
+  '''Django template loader for the layouts of the active site.
+
+  Implements the loader protocol without subclassing Django's BaseLoader,
+  so that importing this module does not import Django.
+  '''
+  is_usable = True
+
+  def __call__(self, template_name, template_dirs=None):
+    return self.load_template(template_name, template_dirs)
+
+  def load_template(self, template_name, template_dirs=None):
+    return (self._layouts(template_name).template(template_name), None)
+
+  def load_template_source(self, template_name, template_dirs=None):
+    layouts = self._layouts(template_name)
+    return (layouts.source(template_name),
+            os.path.join(layouts.path(), template_name))
+
+  def reset(self):
+    pass
+
+  def _layouts(self, template_name):
+    if _active[0] is None:
+      import django.template
+      raise django.template.TemplateDoesNotExist(template_name)
+    return _active[0]
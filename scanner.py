@@ -0,0 +1,525 @@
+'''Hand-written scanner for Creole markup.
+
+An alternative to creole.Parser that builds the same DocNode tree. Instead
+of feeding the whole text through the big block_re and inline_re
+alternations and handling every match (down to single characters) in a
+callback, it walks the text line by line, dispatches on the first character
+of a line or of an inline construct, and appends runs of plain text in one
+go. The individual creole.Rules patterns are only used, anchored, for the
+few constructs whose exact extent they define.
+'''
+import gc
+import re
+
+import creole
+from creole import DocNode
+
+
+_BLOCK_FLAGS = re.X | re.U | re.M
+_INLINE_FLAGS = re.X | re.U
+
+_HEAD_RE = re.compile(creole.Rules.head, _BLOCK_FLAGS)
+_SEPARATOR_RE = re.compile(creole.Rules.separator, _BLOCK_FLAGS)
+_PRE_RE = re.compile(creole.Rules.pre, _BLOCK_FLAGS)
+_LIST_RE = re.compile(creole.Rules.list, _BLOCK_FLAGS)
+_TABLE_RE = re.compile(creole.Rules.table, _BLOCK_FLAGS)
+
+_LINK_RE = re.compile(creole.Rules.link, _INLINE_FLAGS)
+_URL_RE = re.compile(creole.Rules.url, _INLINE_FLAGS)
+_MACRO_RE = re.compile(creole.Rules.macro, _INLINE_FLAGS)
+_IMAGE_RE = re.compile(creole.Rules.image, _INLINE_FLAGS)
+
+# Positions where something other than plain text may start.
+_INLINE_START_RE = re.compile(r'[\[{<*/\\~\n]|(?:%s):' % creole.Rules.proto,
+                              re.U)
+_LINK_TEXT_START_RE = re.compile(r'[{\\\n]')
+
+_CONTAINERS = ('document', 'section', 'blockquote')
+
+# Block rules after which the parser is back at the top of the document, so
+# the text that follows parses the same on its own.
+_RESETTING_RULES = ('line', 'head', 'separator', 'pre')
+
+# Block rules between two of whose lines a chunk grown too long may be cut;
+# see stream_blocks().
+_CUTTABLE_RULES = ('table', 'text')
+
+
+def scan_blocks(raw, pos=0, last_end=None):
+  '''Find the block elements of Creole text.
+
+  Every block rule ends at the end of a line, so scanning resumes at line
+  starts. As with creole.Parser's re.sub, an empty match right where the
+  previous one ended is dropped.
+
+  Args:
+    raw: Creole source
+    pos: (optional) where to start scanning, at the start of a block
+    last_end: (optional) end of the block before pos
+
+  Yields:
+    (rule, start, end, data) for each block in order, where rule is one of
+    'line', 'head', 'separator', 'pre', 'list', 'table' and 'text', and data
+    is the rule's match object, or the line for 'line' and 'text'
+  '''
+  length = len(raw)
+  while pos <= length:
+    if pos and raw[pos - 1] != '\n':
+      if pos == length:
+        break
+      if raw[pos] == '\n':
+        pos += 1
+        continue
+      eol = raw.find('\n', pos)
+      if eol < 0:
+        eol = length
+      yield ('text', pos, eol, raw[pos:eol])
+      pos = last_end = eol
+      continue
+
+    eol = raw.find('\n', pos)
+    if eol < 0:
+      eol = length
+    line = raw[pos:eol]
+    stripped = line.strip()
+    m = None
+
+    if not stripped:
+      # A run of blank lines, up to the last newline before the next
+      # non-blank line.
+      end = eol
+      while end < length:
+        next_eol = raw.find('\n', end + 1)
+        if next_eol < 0:
+          next_eol = length
+        if raw[end + 1:next_eol].strip():
+          break
+        end = next_eol
+      if end > pos or last_end != pos:
+        yield ('line', pos, end, line)
+        last_end = end
+      pos = end > pos and end or end + 1
+      continue
+    elif stripped[0] == '=':
+      rule, m = 'head', _HEAD_RE.match(raw, pos)
+    elif stripped == '----':
+      rule, m = 'separator', _SEPARATOR_RE.match(raw, pos)
+    elif line.startswith('{{{') and not line[3:].strip():
+      rule, m = 'pre', _PRE_RE.match(raw, pos)
+    elif line.lstrip(' \t')[:1] in ('*', '#'):
+      rule, m = 'list', _LIST_RE.match(raw, pos)
+    elif stripped[0] == '|':
+      rule, m = 'table', _TABLE_RE.match(raw, pos)
+
+    if m is None:
+      yield ('text', pos, eol, line)
+      pos = last_end = eol
+    else:
+      yield (rule, pos, m.end(), m)
+      pos = last_end = m.end()
+
+
+def split_blocks(raw):
+  '''Split Creole text into chunks that parse independently.
+
+  Chunks start after blank lines, headers, separators and pre blocks, where
+  the parser is back at the top of the document. Parsing each chunk on its
+  own and concatenating the children of the resulting roots gives the same
+  tree as parsing the whole text.
+
+  Args:
+    raw: Creole source
+
+  Returns:
+    list of chunks whose concatenation is raw
+  '''
+  chunks = []
+  start = 0
+  reset = False
+  for rule, begin, _, _ in scan_blocks(raw):
+    if reset and begin > start:
+      chunks.append(raw[start:begin])
+      start = begin
+    reset = rule in _RESETTING_RULES
+  chunks.append(raw[start:])
+  return chunks
+
+
+def scan_headers(raw):
+  '''Find the headers of Creole text without parsing the other blocks.
+
+  Args:
+    raw: Creole source
+
+  Yields:
+    (level, text) of each header, as the parsers give them
+  '''
+  for rule, _, _, m in scan_blocks(raw):
+    if rule == 'head':
+      yield (len(m.group('head_head')), m.group('head_text').strip())
+
+
+def stream_blocks(pieces, limit=None):
+  '''Split Creole text read in pieces into chunks that parse independently.
+
+  Gives the same chunks as split_blocks on the whole text, but yields each
+  one as soon as the text after it can no longer change it. Only the newly
+  read lines are scanned, resuming at the last block, which more text may
+  still extend.
+
+  With a limit, a chunk that grows past it is also cut between two table
+  rows or two lines of a paragraph, so that a long table or paragraph is not
+  held whole. The chunk after such a cut goes on with the table or
+  paragraph; see document.parse_blocks. Pre blocks and lists are not cut.
+
+  Args:
+    pieces: iterable of unicode strings whose concatenation is the source
+    limit: (optional) length in characters past which an open chunk is cut
+
+  Yields:
+    (chunk, cut) tuples, where the chunks concatenate to the source and cut
+    is true if the chunk was cut off inside a table or paragraph
+  '''
+  rest = u''        # whole lines read, from the start of the open chunk
+  line = u''        # the line being read
+  start = 0         # start of the open chunk in rest
+  pos = 0           # where scanning resumes: the last block seen
+  last_end = None   # end of the block before pos
+  rule = None       # rule of the block before pos
+  cut_at = None     # latest place where the open chunk may be cut
+  open_pre = False
+  for piece in pieces:
+    line += piece
+    end = line.rfind('\n') + 1
+    if not end:
+      continue
+    # Scan only if the new lines can complete something; for an unclosed pre
+    # block that takes a closing '}}}'.
+    waiting = open_pre and '}}}' not in line[:end]
+    rest += line[:end]
+    line = line[end:]
+    if waiting:
+      continue
+    open_pre = False
+    closed = None  # rest with a '}}}' line appended
+    block = None
+    for next_block in scan_blocks(rest, pos, last_end):
+      if block is not None:
+        # The block before this one can no longer change.
+        rule, _, pos, _ = block
+        last_end = pos
+      block = next_block
+      next_rule, begin, _, data = block
+      if rule in _RESETTING_RULES and begin > start:
+        yield (rest[start:begin], False)
+        start = begin
+        cut_at = None
+      # A later '}}}' may still close a pre block at a '{{{' line that does
+      # not start one yet, or lengthen one whose '{{{' line is followed by
+      # blank lines, since the pre rule prefers to skip them.
+      if (next_rule == 'text' and data.startswith('{{{')
+          and not data[3:].strip() and (begin == 0 or rest[begin - 1] == '\n')):
+        open_pre = True
+        break
+      if next_rule == 'pre':
+        if closed is None:
+          closed = rest + u'}}}\n'
+        if _PRE_RE.match(closed, begin).end() != data.end():
+          open_pre = True
+          break
+      if (next_rule == rule and rule in _CUTTABLE_RULES and begin > start
+          and rest[begin - 1] == '\n'):
+        cut_at = begin
+    if block is not None:
+      # Resume at the last block, which more text may still extend.
+      pos = block[1]
+      # Let go of the match objects, so that rest can grow in place.
+      block = next_block = data = None
+    if limit and cut_at is not None and len(rest) - start > limit:
+      yield (rest[start:cut_at], True)
+      start = cut_at
+      cut_at = None
+    if start:
+      rest = rest[start:]
+      pos -= start
+      if last_end is not None:
+        last_end -= start
+      if cut_at is not None:
+        cut_at -= start
+      start = 0
+  rest += line
+  for next_rule, begin, _, _ in scan_blocks(rest, pos, last_end):
+    if rule in _RESETTING_RULES and begin > start:
+      yield (rest[start:begin], False)
+      start = begin
+    rule = next_rule
+  if start < len(rest):
+    yield (rest[start:], False)
+
+
+class Parser(object):
+  '''Parse Creole text into a DocNode tree, like creole.Parser.'''
+
+  def __init__(self, raw):
+    self.raw = raw
+    self.root = DocNode('document', None)
+    self.cur = self.root  # The most recent document node
+    self.text = None      # The node to add inline characters to
+
+  def parse(self):
+    '''Parse the text given as self.raw and return DOM tree.'''
+    # Nothing becomes garbage while the tree grows, but its many new nodes
+    # keep triggering the cyclic garbage collector, whose full passes take
+    # longer the larger the tree is; hold it off until the tree is built.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+      self.parse_block(self.raw)
+    finally:
+      if collecting:
+        gc.enable()
+    return self.root
+
+  def _upto(self, node, kinds):
+    while node.parent is not None and not node.kind in kinds:
+      node = node.parent
+    return node
+
+  # Block level.
+
+  def parse_block(self, raw):
+    '''Recognize block elements.'''
+    handlers = {
+      'line': self._line_block,
+      'head': self._head_block,
+      'separator': self._separator_block,
+      'pre': self._pre_block,
+      'list': self._list_block,
+      'table': self._table_block,
+      'text': self._text_block,
+    }
+    for rule, _, _, data in scan_blocks(raw):
+      handlers[rule](data)
+
+  def _line_block(self, line):
+    self.cur = self._upto(self.cur, _CONTAINERS)
+
+  def _head_block(self, m):
+    self.cur = self._upto(self.cur, _CONTAINERS)
+    node = DocNode('header', self.cur, m.group('head_text').strip())
+    node.level = len(m.group('head_head'))
+
+  def _separator_block(self, m):
+    self.cur = self._upto(self.cur, _CONTAINERS)
+    DocNode('separator', self.cur)
+
+  def _pre_block(self, m):
+    self.cur = self._upto(self.cur, _CONTAINERS)
+    text = m.group('pre_text')
+    if '~' in text:
+      text = creole.Parser.pre_escape_re.sub(
+        lambda m: m.group('indent') + m.group('rest'), text)
+    node = DocNode('preformatted', self.cur, text)
+    node.sect = m.group('pre_kind') or ''
+    self.text = None
+
+  def _list_block(self, m):
+    for item in creole.Parser.item_re.finditer(m.group('list')):
+      self._item(item.group('item_head'), item.group('item_text'))
+
+  def _item(self, bullet, text):
+    if bullet[-1] == '#':
+      kind = 'number_list'
+    else:
+      kind = 'bullet_list'
+    level = len(bullet)
+    lst = self.cur
+    # Find a list of the same kind and level up the tree
+    while (lst and
+           not (lst.kind in ('number_list', 'bullet_list') and
+                lst.level == level) and
+           not lst.kind in _CONTAINERS):
+      lst = lst.parent
+    if lst and lst.kind == kind:
+      self.cur = lst
+    else:
+      # Create a new level of list
+      self.cur = self._upto(self.cur, ('list_item',) + _CONTAINERS)
+      self.cur = DocNode(kind, self.cur)
+      self.cur.level = level
+    self.cur = DocNode('list_item', self.cur)
+    self.parse_inline(text)
+    self.text = None
+
+  def _table_block(self, m):
+    row = m.group('table').strip()
+    self.cur = self._upto(self.cur, ('table',) + _CONTAINERS)
+    if self.cur.kind != 'table':
+      self.cur = DocNode('table', self.cur)
+    tb = self.cur
+    tr = DocNode('table_row', tb)
+    for cell_m in creole.Parser.cell_re.finditer(row):
+      cell = cell_m.group('cell')
+      if cell:
+        self.cur = DocNode('table_cell', tr)
+        self.text = None
+        self.parse_inline(cell)
+      else:
+        self.cur = DocNode('table_head', tr)
+        self.text = DocNode('text', self.cur,
+                            cell_m.group('head').strip('='))
+    self.cur = tb
+    self.text = None
+
+  def _text_block(self, line):
+    if self.cur.kind in ('table', 'table_row', 'bullet_list', 'number_list'):
+      self.cur = self._upto(self.cur, _CONTAINERS)
+    if self.cur.kind in _CONTAINERS:
+      self.cur = DocNode('paragraph', self.cur)
+    self.parse_inline(line + ' ')
+    self.text = None
+
+  # Inline level.
+
+  def parse_inline(self, raw):
+    '''Recognize inline elements inside blocks.'''
+    length = len(raw)
+    pos = 0
+    search = _INLINE_START_RE.search
+    while pos < length:
+      m = search(raw, pos)
+      if m is None:
+        self._chars(raw[pos:])
+        return
+      start = m.start()
+      if start > pos:
+        self._chars(raw[pos:start])
+      pos = self._inline(raw, start)
+
+  def _inline(self, raw, pos):
+    '''Handle the inline element at pos and return where it ends.
+
+    Rules are tried in creole.Parser's order; a position that starts none of
+    them is a plain character.
+    '''
+    char = raw[pos]
+    if char == '\n':
+      return pos + 1
+    if char == '[' and raw.startswith('[[', pos):
+      m = _LINK_RE.match(raw, pos)
+      if m:
+        self._link(m.group('link_target'), m.group('link_text'))
+        return m.end()
+    elif char == '<' and raw.startswith('<<', pos):
+      m = _MACRO_RE.match(raw, pos)
+      if m:
+        self._macro(m.group('macro_name'), m.group('macro_args'),
+                    m.group('macro_text'))
+        return m.end()
+    elif char == '{' and raw.startswith('{{', pos):
+      if raw.startswith('{{{', pos):
+        end = raw.find('}}}', pos + 3)
+        if end >= 0 and '\n' not in raw[pos + 3:end]:
+          DocNode('code', self.cur, raw[pos + 3:end].strip())
+          self.text = None
+          return end + 3
+      m = _IMAGE_RE.match(raw, pos)
+      if m:
+        self._image(m.group('image_target'), m.group('image_text'))
+        return m.end()
+    elif char == '*' and raw.startswith('**', pos):
+      self._toggle('strong')
+      return pos + 2
+    elif char == '/' and raw.startswith('//', pos):
+      if not pos or raw[pos - 1] != ':':
+        self._toggle('emphasis')
+        return pos + 2
+    elif char == '\\' and raw.startswith('\\\\', pos):
+      DocNode('break', self.cur, None)
+      self.text = None
+      return pos + 2
+    elif char == '~' or char.isalpha():
+      m = _URL_RE.match(raw, pos)
+      if m:
+        self._url(m.group('url_target'), m.group('escaped_url'))
+        return m.end()
+      if char == '~' and pos + 1 < len(raw) and not raw[pos + 1].isspace():
+        self._chars(raw[pos + 1])
+        return pos + 2
+    self._chars(char)
+    return pos + 1
+
+  def _chars(self, text):
+    if self.text is None:
+      self.text = DocNode('text', self.cur, u'')
+    self.text.content += text
+
+  def _toggle(self, kind):
+    if self.cur.kind != kind:
+      self.cur = DocNode(kind, self.cur)
+    else:
+      self.cur = self._upto(self.cur, (kind,)).parent
+    self.text = None
+
+  def _url(self, target, escaped):
+    if escaped:
+      self._chars(target)
+      return
+    node = DocNode('link', self.cur)
+    node.content = target
+    DocNode('text', node, node.content)
+    self.text = None
+
+  def _link(self, target, text):
+    text = (text or '').strip()
+    parent = self.cur
+    self.cur = DocNode('link', self.cur)
+    self.cur.content = target
+    self.text = None
+    self._link_text(text)
+    self.cur = parent
+    self.text = None
+
+  def _link_text(self, raw):
+    '''Recognize the images and line breaks allowed in link descriptions.'''
+    length = len(raw)
+    pos = 0
+    search = _LINK_TEXT_START_RE.search
+    while pos < length:
+      m = search(raw, pos)
+      if m is None:
+        self._chars(raw[pos:])
+        return
+      start = m.start()
+      if start > pos:
+        self._chars(raw[pos:start])
+      pos = start + 1
+      char = raw[start]
+      if char == '\n':
+        continue
+      if char == '{' and raw.startswith('{{', start):
+        image = _IMAGE_RE.match(raw, start)
+        if image:
+          self._image(image.group('image_target'), image.group('image_text'))
+          pos = image.end()
+          continue
+      elif char == '\\' and raw.startswith('\\\\', start):
+        DocNode('break', self.cur, None)
+        self.text = None
+        pos = start + 2
+        continue
+      self._chars(char)
+
+  def _macro(self, name, args, text):
+    text = (text or '').strip()
+    node = DocNode('macro', self.cur, name)
+    node.args = args or ''
+    DocNode('text', node, text or name)
+    self.text = None
+
+  def _image(self, target, text):
+    target = target.strip()
+    text = (text or '').strip()
+    node = DocNode('image', self.cur, target)
+    DocNode('text', node, text or node.content)
+    self.text = None
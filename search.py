@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import re
+
+import document
+
+
+# Bump when the tokenizer or the index layout changes to discard saved state.
+INDEX_VERSION = 1
+
+# DocNode kinds whose content is indexed text.
+TEXT_KINDS = ('text', 'header', 'code', 'preformatted')
+
+TERM_RE = re.compile(r'\w+', re.U)
+
+
+def extract_terms(nodes):
+  '''Extract search terms and their positions from DocNode trees.
+
+  Args:
+    nodes: iterable of DocNodes, e.g. the top-level nodes of a document
+
+  Returns:
+    dict of term -> list of token positions within the document
+  '''
+  terms = {}
+  position = 0
+  for root in nodes:
+    stack = [root]
+    while stack:
+      node = stack.pop()
+      if node.kind in TEXT_KINDS and node.content:
+        for m in TERM_RE.finditer(node.content):
+          terms.setdefault(m.group(0).lower(), []).append(position)
+          position += 1
+      stack.extend(reversed(node.children))
+  return terms
+
+
+def shard_key(term):
+  '''Get the name of the index shard that holds a term.
+
+  Args:
+    term: lowercase term
+
+  Returns:
+    shard name: the term's first character if it is in [a-z0-9], else '_'
+  '''
+  c = term[0]
+  if ('a' <= c <= 'z') or ('0' <= c <= '9'):
+    return str(c)
+  return '_'
+
+
+class SearchIndex(object):
+  '''Inverted index of the documents in a site.
+
+  Terms are kept per document along with the digest of the source file, so
+  only documents whose source changed since the last build are re-tokenized.
+  The state is saved between builds in the cache directory.
+
+  The emitted index is sharded by the first character of each term:
+    search/docs.json: list of [url, title] pairs; a doc ID is an index here
+    search/<shard>.json: {term: [[doc ID, [positions...]], ...], ...}
+  '''
+  def __init__(self, state_path=None):
+    '''Constructor.
+
+    Args:
+      state_path: (optional) path of the saved index state
+    '''
+    self._state_path = state_path
+    self._docs = {}
+    self._seen = set()
+    self._updated = 0
+    self._load()
+
+  def _read(self, path):
+    if not path or not os.path.isfile(path):
+      return {}
+    try:
+      fh = open(path, 'r')
+      state = json.load(fh)
+      fh.close()
+    except ValueError, e:
+      logging.warning('Ignoring bad search index state: %s' % e)
+      return {}
+    if state.get('version') != INDEX_VERSION:
+      return {}
+    return state['docs']
+
+  def _load(self):
+    self._docs = self._read(self._state_path)
+
+  def dumps(self):
+    '''Get the index state as a JSON string.'''
+    return json.dumps({'version': INDEX_VERSION, 'docs': self._docs},
+                      separators=(',', ':'))
+
+  def save(self):
+    '''Save the index state for the next build.'''
+    if not self._state_path:
+      return
+    cache_dir = os.path.dirname(self._state_path)
+    if cache_dir and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    temp_path = '%s~' % self._state_path
+    fh = open(temp_path, 'w')
+    fh.write(self.dumps())
+    fh.close()
+    os.rename(temp_path, self._state_path)
+
+  def merge(self, path):
+    '''Add the documents of another saved index state, e.g. from a shard.
+
+    Args:
+      path: path of the saved state
+    '''
+    docs = self._read(path)
+    self._docs.update(docs)
+    self._seen.update(docs.keys())
+
+  def update(self, doc):
+    '''Add a document to the index, re-tokenizing it only if it changed.
+
+    Args:
+      doc: document.Document
+
+    Returns:
+      True if the document was (re-)indexed
+    '''
+    name = doc.name()
+    digest = doc.file().digest()
+    self._seen.add(name)
+
+    entry = self._docs.get(name)
+    if entry is not None and entry['digest'] == digest:
+      return False
+
+    self._docs[name] = {'digest': digest,
+                        'title': doc.title(),
+                        'terms': extract_terms(doc.blocks())}
+    self._updated += 1
+    return True
+
+  def updated(self):
+    '''Get the number of documents (re-)indexed by update().'''
+    return self._updated
+
+  def prune(self):
+    '''Drop documents that were not passed to update() during this build.'''
+    for name in self._docs.keys():
+      if name not in self._seen:
+        del self._docs[name]
+
+  def files(self):
+    '''Render the index.
+
+    Returns:
+      dict of output file name (relative to the site root) -> JSON string
+    '''
+    names = sorted(self._docs.keys())
+    docs = []
+    shards = {}
+    for docid, name in enumerate(names):
+      entry = self._docs[name]
+      docs.append([document.document_url(name), entry['title']])
+      for term, positions in entry['terms'].iteritems():
+        postings = shards.setdefault(shard_key(term), {})
+        postings.setdefault(term, []).append([docid, positions])
+
+    files = {'search/docs.json': json.dumps(docs, separators=(',', ':'))}
+    for key, postings in shards.iteritems():
+      files['search/%s.json' % key] = json.dumps(postings, sort_keys=True,
+                                                 separators=(',', ':'))
+    return files
@@ -0,0 +1,106 @@
+import os
+import SimpleHTTPServer
+import SocketServer
+import urllib
+import urlparse
+
+import assets
+
+
+# Cache-Control of fingerprinted files, whose names change with their content.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Fingerprinted names from asset manifests, with the mtime they were read
+# at, by manifest path.
+_fingerprinted = {}
+
+
+def sitePath():
+  siteDir = '_site'
+  if os.path.isdir(siteDir):
+    return siteDir
+  return None
+
+
+def acceptsGzip(accept_encoding):
+  '''Returns true if an Accept-Encoding header value allows gzip.'''
+  for coding in accept_encoding.split(','):
+    params = [p.strip() for p in coding.split(';')]
+    if params[0].lower() not in ('gzip', '*'):
+      continue
+    for param in params[1:]:
+      if param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+        break
+    else:
+      return True
+  return False
+
+
+def fingerprintedNames(root):
+  '''Get the fingerprinted file names of a built site.
+
+  The asset manifest is read again when a build changes it.
+
+  Args:
+    root: directory the site is served from
+  '''
+  path = os.path.join(root, assets.MANIFEST_NAME)
+  try:
+    mtime = os.path.getmtime(path)
+  except OSError:
+    mtime = None
+  entry = _fingerprinted.get(path)
+  if entry is None or entry[0] != mtime:
+    entry = (mtime, assets.load_manifest(path).fingerprinted())
+    _fingerprinted[path] = entry
+  return entry[1]
+
+
+class SiteRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  '''Request handler that serves precompressed .gz siblings if accepted, and
+  fingerprinted files with headers that let them be cached for good.'''
+  def send_head(self):
+    name = urllib.unquote(urlparse.urlsplit(self.path).path).lstrip('/')
+    self._immutable = name in fingerprintedNames(self.translate_path('/'))
+
+    path = self.translate_path(self.path)
+    if os.path.isdir(path) and self.path.endswith('/'):
+      path = os.path.join(path, 'index.html')
+
+    gz_path = '%s.gz' % path
+    # Both variants of a file with a .gz sibling depend on Accept-Encoding.
+    self._vary = os.path.isfile(path) and os.path.isfile(gz_path)
+    if (not self._vary or
+        not acceptsGzip(self.headers.get('Accept-Encoding', ''))):
+      return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    try:
+      f = open(gz_path, 'rb')
+    except IOError:
+      return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    self.send_response(200)
+    self.send_header('Content-Type', self.guess_type(path))
+    self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(os.fstat(f.fileno())[6]))
+    self.end_headers()
+    return f
+
+  def end_headers(self):
+    if getattr(self, '_vary', False):
+      self.send_header('Vary', 'Accept-Encoding')
+    if getattr(self, '_immutable', False):
+      self.send_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+    SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+
+def startServer(address):
+  handlerClass = SiteRequestHandler
+  httpd = SocketServer.TCPServer(address, handlerClass)
+  path = sitePath()
+  if path is None:
+    return None  # No serving path
+  os.chdir(path)
+
+  print 'HTTP server at http://%s:%d' % address
+  httpd.serve_forever()
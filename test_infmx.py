@@ -0,0 +1,159 @@
+#!/usr/bin/env python2.6
+# -*- mode: Python -*-
+'''Unit tests for infmx internals.
+
+usage: test_infmx.py [unittest options]
+'''
+import cStringIO
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import filesystem
+import imagesize
+
+
+class GlobTest(unittest.TestCase):
+  def assertMatches(self, pattern, names, expected=True):
+    patterns = filesystem.PathPatterns([pattern])
+    for name in names:
+      self.assertEqual(patterns.matches(name), expected,
+                       '%r matching %r' % (pattern, name))
+
+  def assertNoMatches(self, pattern, names):
+    self.assertMatches(pattern, names, False)
+
+  def testPlainPathIsAnchored(self):
+    self.assertMatches('drafts', ['drafts'])
+    self.assertNoMatches('drafts', ['a/drafts', 'drafts.txt', 'xdrafts'])
+    self.assertMatches('/README', ['README'])
+    self.assertNoMatches('/README', ['docs/README'])
+
+  def testPatternWithSlashIsAnchored(self):
+    self.assertMatches('a/*.txt', ['a/x.txt', 'a/.txt'])
+    self.assertNoMatches('a/*.txt', ['a/b/x.txt', 'b/a/x.txt', 'x.txt'])
+
+  def testWildcardNameMatchesAtAnyDepth(self):
+    self.assertMatches('*.swp', ['x.swp', 'a/x.swp', 'a/b/.x.swp'])
+    self.assertNoMatches('*.swp', ['x.swpx', 'a.swp/x'])
+    self.assertMatches('?.txt', ['a.txt', 'd/b.txt'])
+    self.assertNoMatches('?.txt', ['ab.txt', '/.txt'])
+
+  def testCharacterClasses(self):
+    self.assertMatches('[ab].txt', ['a.txt', 'b.txt'])
+    self.assertNoMatches('[ab].txt', ['c.txt'])
+    self.assertMatches('[!ab].txt', ['c.txt'])
+    self.assertNoMatches('[!ab].txt', ['a.txt'])
+
+  def testDoubleStar(self):
+    self.assertMatches('drafts/**', ['drafts', 'drafts/x', 'drafts/a/b.txt'])
+    self.assertNoMatches('drafts/**', ['draftsx', 'x/drafts/y'])
+    self.assertMatches('**/x.txt', ['x.txt', 'a/x.txt', 'a/b/x.txt'])
+    self.assertNoMatches('**/x.txt', ['ax.txt'])
+    self.assertMatches('a/**/b', ['a/b', 'a/x/b', 'a/x/y/b'])
+    self.assertNoMatches('a/**/b', ['a/xb', 'b'])
+
+  def testSingleStarStaysInSegment(self):
+    self.assertMatches('a/*', ['a/x'])
+    self.assertNoMatches('a/*', ['a/x/y'])
+
+  def testEscapePattern(self):
+    path = 'a*b/[1]?.txt'
+    pattern = filesystem.escape_pattern(path)
+    self.assertMatches(pattern, [path])
+    self.assertNoMatches(pattern, ['axb/1x.txt', 'a*b/1?.txt'])
+    self.assertEqual(filesystem.escape_pattern('plain/name.txt'),
+                     'plain/name.txt')
+
+  def testMatchesBelow(self):
+    patterns = filesystem.PathPatterns(['drafts/keep.txt', 'a/**'])
+    self.assertTrue(patterns.matchesBelow('drafts'))
+    self.assertFalse(patterns.matchesBelow('drafts/sub'))
+    self.assertFalse(patterns.matchesBelow('other'))
+    self.assertTrue(patterns.matchesBelow('a'))
+    self.assertTrue(patterns.matchesBelow('a/b/c'))
+    self.assertTrue(filesystem.PathPatterns(['*.txt']).matchesBelow('x/y'))
+    self.assertFalse(filesystem.PathPatterns().matchesBelow('x'))
+
+
+class FilesystemTest(unittest.TestCase):
+  FILES = ['top.txt', 'drafts/keep.txt', 'drafts/other.txt',
+           'drafts/sub/deep.txt', 'notes/a.txt']
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    for name in self.FILES:
+      path = os.path.join(self.root, name)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      open(path, 'w').close()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def list(self, exclude=None, include=None):
+    return filesystem.Filesystem(self.root, exclude, include).list()
+
+  def testExcludeDirectory(self):
+    self.assertEqual(self.list(['drafts']), ['notes/a.txt', 'top.txt'])
+    self.assertEqual(self.list(['drafts/**']), ['notes/a.txt', 'top.txt'])
+
+  def testIncludeInsideExcludedDirectory(self):
+    self.assertEqual(self.list(['drafts'], ['drafts/keep.txt']),
+                     ['drafts/keep.txt', 'notes/a.txt', 'top.txt'])
+    self.assertEqual(self.list(['drafts/**'], ['drafts/sub/*.txt']),
+                     ['drafts/sub/deep.txt', 'notes/a.txt', 'top.txt'])
+    self.assertEqual(self.list(['drafts', 'notes'], ['keep.txt']),
+                     ['top.txt'])
+    self.assertEqual(self.list(['drafts', 'notes'], ['*.txt']),
+                     ['drafts/keep.txt', 'drafts/other.txt',
+                      'drafts/sub/deep.txt', 'notes/a.txt', 'top.txt'])
+
+  def testIncludeDoesNotAddUnexcludedFiles(self):
+    self.assertEqual(self.list(['*.txt'], ['top.txt']), ['top.txt'])
+
+
+def png(width, height):
+  return ('\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR' +
+          struct.pack('>II', width, height) + '\x08\x02\x00\x00\x00')
+
+
+def gif(width, height):
+  return 'GIF89a' + struct.pack('<HH', width, height) + '\x00\x00\x00'
+
+
+def jpeg(width, height):
+  app0 = '\xff\xe0' + struct.pack('>H', 16) + 'JFIF\x00' + '\x00' * 9
+  sof0 = ('\xff\xc0' + struct.pack('>HBHH', 17, 8, height, width) +
+          '\x03' + '\x00' * 9)
+  return '\xff\xd8' + app0 + sof0 + '\xff\xd9'
+
+
+class ImageSizeTest(unittest.TestCase):
+  def size(self, data):
+    return imagesize.image_size(cStringIO.StringIO(data))
+
+  def testPng(self):
+    self.assertEqual(self.size(png(640, 480)), (640, 480))
+
+  def testGif(self):
+    self.assertEqual(self.size(gif(16, 9)), (16, 9))
+
+  def testJpeg(self):
+    self.assertEqual(self.size(jpeg(1024, 768)), (1024, 768))
+
+  def testJpegFillBytes(self):
+    data = jpeg(3, 2)
+    data = data[:2] + '\xff\xff' + data[2:]
+    self.assertEqual(self.size(data), (3, 2))
+
+  def testUnknownOrTruncated(self):
+    self.assertEqual(self.size('not an image'), None)
+    self.assertEqual(self.size(''), None)
+    self.assertEqual(self.size(jpeg(3, 2)[:24]), None)
+
+
+if __name__ == '__main__':
+  unittest.main()